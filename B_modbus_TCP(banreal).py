@@ -1,4 +1,4 @@
-import sys, time, socket, threading, json
+import sys, time, socket, threading, json, struct
 from collections import deque
 
 from PyQt5.QtWidgets import (
@@ -39,6 +39,11 @@ AUTO_STATE_MAP = {
     8: "Manual",
 }
 
+# Ghép/tách 32-bit có dấu ↔ 2 thanh ghi Big Endian bằng packer C của struct
+_U32 = struct.Struct(">I")
+_S32 = struct.Struct(">i")
+_REGS2 = struct.Struct(">HH")
+
 
 # =========================================
 # SIGNAL EMITTER
@@ -726,18 +731,11 @@ class LayerB_SCADASupervisor(QWidget):
 
     @staticmethod
     def _regs_to_s32(hi, lo):
-        val = ((hi & 0xFFFF) << 16) | (lo & 0xFFFF)
-        if val & 0x80000000:
-            val = val - (1 << 32)
-        return val
+        return _S32.unpack(_REGS2.pack(hi & 0xFFFF, lo & 0xFFFF))[0]
 
     @staticmethod
     def _s32_to_regs(val):
-        if val < 0:
-            val = (1 << 32) + val
-        hi = (val >> 16) & 0xFFFF
-        lo = val & 0xFFFF
-        return hi, lo
+        return _REGS2.unpack(_U32.pack(val & 0xFFFFFFFF))
 
     def poll_a_status_from_a(self):
         """Đọc Input Registers 0..11 từ Layer A (mở rộng thêm STEP/JOG)."""
@@ -2,6 +2,7 @@ import sys
 import time
 import struct
 import threading
+import functools
 import serial
 
 from PyQt5.QtWidgets import (
@@ -19,6 +20,12 @@ MODBUS_TCP_PORT = 502
 
 SERIAL_TIMEOUT = 1.0
 READ_INTERVAL_MS = 300
+BATCH_DRIVE_READS = True    # False nếu driver từ chối đọc span 0x1000..0x1010
+AUTO_CYCLE_MS = 200
+SCHED_TICK_MS = 50          # chu kỳ dispatcher của scheduler
+SCHED_MAX_BACKOFF_MS = 5000  # chu kỳ tối đa khi tác vụ lỗi liên tiếp
+SHUTDOWN_TIMEOUT = 1.0       # thời gian chờ tối đa khi đóng serial/server (s)
+MOTOR_INPOS_TIMEOUT_NS = 10 * 1_000_000_000  # chờ InPos tối đa 10 s
 
 SLAVE_ID_DRIVER = 2
 SLAVE_ID_SHT20 = 1
@@ -34,92 +41,152 @@ HR_MODE_ADDR = 8          # 0=AUTO, 1=MANUAL
 HR_CMD_ADDR = 10          # packet lệnh MANUAL từ B/C
 HR_CMD_REG_COUNT = 6      # CMD, POS_HI, POS_LO, SPEED, SOURCE, PRIORITY
 
+# Mã trạng thái AUTO publish ra Input Register 8
+AUTO_STATE_CODES = {
+    "Idle": 0,
+    "Waiting count": 1,
+    "Motor running": 2,
+    "Waiting reset": 3,
+    "Alarm": 4,
+    "Timeout motor": 5,
+    "Disabled": 6,
+    "Waiting target": 7,
+    "Manual": 8,
+}
+
 
 # ==========================
 # MODBUS RTU HELPER
 # ==========================
-def crc16_modbus(data: bytes) -> int:
-    crc = 0xFFFF
-    for b in data:
-        crc ^= b
+def _make_crc16_table() -> tuple:
+    table = []
+    for i in range(256):
+        crc = i
         for _ in range(8):
             if crc & 1:
                 crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
-    return crc & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+# Bảng CRC16 (đa thức 0xA001) tính sẵn: mỗi byte chỉ còn 1 lần tra bảng
+# thay cho vòng lặp 8 bit
+_CRC16_TABLE = _make_crc16_table()
+
+
+def crc16_modbus(data) -> int:
+    """CRC16 Modbus của bytes/bytearray/memoryview (mọi buffer byte)"""
+    crc = 0xFFFF
+    table = _CRC16_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
 
 
 def verify_crc(resp: bytes) -> bool:
-    if len(resp) < 5:
-        return False
-    data = resp[:-2]
-    recv_crc = resp[-2] | (resp[-1] << 8)
-    calc_crc = crc16_modbus(data)
-    return recv_crc == calc_crc
+    # CRC16 Modbus tính trên cả frame (kể cả 2 byte CRC little-endian) bằng 0
+    # khi frame đúng → không cần cắt resp[:-2]; nhận bytes/bytearray/memoryview
+    return len(resp) >= 5 and crc16_modbus(resp) == 0
+
 
+# Header 6 byte (slave, FC, địa chỉ, số lượng/giá trị) và CRC (little-endian)
+# đóng gói bằng struct thay cho tách byte thủ công
+_PACK_HDR = struct.Struct(">BBHH").pack
+_PACK_CRC = struct.Struct("<H").pack
 
+
+# Các frame đọc/ghi đơn lặp lại liên tục trong vòng polling và lệnh manual
+# → cache theo tham số để CRC chỉ tính ở lần gọi đầu (frame là bytes, bất biến)
+@functools.lru_cache(maxsize=64)
 def build_fc03(slave_id: int, start_reg: int, count: int) -> bytes:
-    data = bytes([
-        slave_id, 0x03,
-        (start_reg >> 8) & 0xFF, start_reg & 0xFF,
-        (count >> 8) & 0xFF, count & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x03, start_reg, count)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 
+@functools.lru_cache(maxsize=64)
 def build_fc04(slave_id: int, start_reg: int, count: int) -> bytes:
-    data = bytes([
-        slave_id, 0x04,
-        (start_reg >> 8) & 0xFF, start_reg & 0xFF,
-        (count >> 8) & 0xFF, count & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x04, start_reg, count)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 
+@functools.lru_cache(maxsize=64)
 def build_fc06(slave_id: int, reg_addr: int, reg_val: int) -> bytes:
-    data = bytes([
-        slave_id, 0x06,
-        (reg_addr >> 8) & 0xFF, reg_addr & 0xFF,
-        (reg_val >> 8) & 0xFF, reg_val & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x06, reg_addr, reg_val & 0xFFFF)
+    return data + _PACK_CRC(crc16_modbus(data))
+
+
+# Header FC16 (slave, FC, địa chỉ, số thanh ghi, số byte) chỉ phụ thuộc lệnh
+# → dựng một lần; dữ liệu và CRC vẫn tính mới mỗi lần gửi
+@functools.lru_cache(maxsize=64)
+def _fc16_header(slave_id: int, start_reg: int, reg_count: int) -> bytes:
+    return struct.pack(">BBHHB", slave_id, 0x10, start_reg, reg_count, reg_count * 2)
 
 
 def build_fc16(slave_id: int, start_reg: int, registers: list) -> bytes:
     reg_count = len(registers)
-    byte_count = reg_count * 2
-    data = bytearray([
-        slave_id, 0x10,
-        (start_reg >> 8) & 0xFF, start_reg & 0xFF,
-        (reg_count >> 8) & 0xFF, reg_count & 0xFF,
-        byte_count
-    ])
-    for reg in registers:
-        data.append((reg >> 8) & 0xFF)
-        data.append(reg & 0xFF)
-    crc = crc16_modbus(bytes(data))
-    return bytes(data) + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _fc16_header(slave_id, start_reg, reg_count) + _regs_struct(reg_count).pack(*registers)
+    return data + _PACK_CRC(crc16_modbus(data))
+
+
+# Packer C-coded của struct: tách/ghép 32-bit ↔ 2 thanh ghi Big Endian,
+# struct tự xử lý dấu (two's complement) nên không cần nhánh if
+_U32 = struct.Struct(">I")
+_S32 = struct.Struct(">i")
+_REGS2 = struct.Struct(">HH")
 
 
 def pack_u32(val: int) -> list:
-    return [(val >> 16) & 0xFFFF, val & 0xFFFF]
+    return list(_REGS2.unpack(_U32.pack(val & 0xFFFFFFFF)))
 
 
 def pack_s32(val: int) -> list:
-    if val < 0:
-        val = (1 << 32) + val
-    return [(val >> 16) & 0xFFFF, val & 0xFFFF]
+    return list(_REGS2.unpack(_S32.pack(val)))
 
 
 def unpack_s32_from_bytes(b: bytes, offset: int) -> int:
-    val = (b[offset] << 24) | (b[offset+1] << 16) | (b[offset+2] << 8) | b[offset+3]
-    if val & 0x80000000:
-        val = val - (1 << 32)
-    return val
+    return _S32.unpack_from(b, offset)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _regs_struct(count: int) -> struct.Struct:
+    return struct.Struct(">%dH" % count)
+
+
+def unpack_regs(resp: bytes, count: int) -> tuple:
+    """`count` thanh ghi 16-bit Big Endian trong payload FC03/FC04 (sau 3 byte header)"""
+    return _regs_struct(count).unpack_from(resp, 3)
+
+
+def t35_seconds(baudrate: int) -> float:
+    """Khoảng lặng 3.5 ký tự (11 bit/ký tự) giữa hai frame RTU; trên 19200 baud cố định 1.75 ms"""
+    return max(0.00175, 3.5 * 11 / baudrate)
+
+
+def read_rtu_response(ser) -> bytes:
+    """Đọc đúng một frame phản hồi RTU, độ dài suy ra từ header [slave, FC, byte_count/mã lỗi]:
+    FC03/04 còn byte_count + 2 CRC, exception (FC | 0x80) còn 2 CRC, echo FC06/16 đủ 8 byte.
+    Mỗi ser.read(n) chặn tới khi đủ n byte hoặc hết timeout của cổng."""
+    header = ser.read(3)
+    if len(header) < 3:
+        return header
+    fc = header[1]
+    if fc & 0x80:
+        remaining = 2
+    elif fc in (0x03, 0x04):
+        remaining = header[2] + 2
+    else:
+        remaining = 5
+    return header + ser.read(remaining)
+
+
+def _close_quietly(fn):
+    """Gọi hàm close/stop, bỏ qua mọi lỗi (dùng khi tắt ứng dụng)"""
+    try:
+        fn()
+    except Exception:
+        pass
 
 
 # ==========================
@@ -142,6 +209,9 @@ class LayerA_PLC(QWidget):
         # Serial / Modbus RTU
         self.ser = None
         self.ser_lock = threading.Lock()
+        self.t35 = t35_seconds(9600)  # Tính lại theo baud khi kết nối
+        # Chỉ xả input buffer khi vừa kết nối hoặc frame trước lỗi (timeout/CRC)
+        self._needs_resync = True
 
         # Driver state
         self.current_position = 0
@@ -163,7 +233,7 @@ class LayerA_PLC(QWidget):
         # AUTO logic
         self.auto_enabled = True
         self.motor_state = "Idle"
-        self.last_motor_cmd_time = time.time()
+        self._last_motor_cmd_ns = time.monotonic_ns()
 
         # Target nhận từ Modbus TCP HR0
         self.last_tcp_target = 0
@@ -180,14 +250,44 @@ class LayerA_PLC(QWidget):
         self._build_ui()
         self._start_modbus_tcp_server()
 
-        # Timers
-        self.timer_read = QTimer()
-        self.timer_read.timeout.connect(self.read_all_devices)
-        self.timer_read.start(READ_INTERVAL_MS)
+        # Scheduler: một QTimer duy nhất điều phối mọi tác vụ định kỳ
+        # [callback, chu kỳ gốc (ms), chu kỳ hiện tại (ms), monotonic_ns chạy kế tiếp]
+        self._schedule = [
+            [self.read_all_devices, READ_INTERVAL_MS, READ_INTERVAL_MS, 0],
+            [self.auto_cycle, AUTO_CYCLE_MS, AUTO_CYCLE_MS, 0],
+        ]
+        self.timer_sched = QTimer()
+        self.timer_sched.timeout.connect(self._run_schedule)
+        self.timer_sched.start(SCHED_TICK_MS)
 
-        self.timer_auto = QTimer()
-        self.timer_auto.timeout.connect(self.auto_cycle)
-        self.timer_auto.start(200)
+    # --------------------------
+    # SCHEDULER
+    # --------------------------
+    def _run_schedule(self):
+        """Chạy lần lượt các tác vụ đến hạn, không bao giờ chồng lệnh trên bus.
+
+        Tác vụ trả về False (vd: không thiết bị nào phản hồi) bị nhân đôi chu kỳ
+        đến SCHED_MAX_BACKOFF_MS; lần chạy thành công đưa chu kỳ về giá trị gốc.
+        """
+        for task in self._schedule:
+            func, base_ms, period_ms, next_fire = task
+            if time.monotonic_ns() < next_fire:
+                continue
+
+            ok = func()
+            if ok is False:
+                period_ms = min(period_ms * 2, SCHED_MAX_BACKOFF_MS)
+            else:
+                period_ms = base_ms
+
+            task[2] = period_ms
+            task[3] = time.monotonic_ns() + period_ms * 1_000_000
+
+    def _reset_schedule(self):
+        """Đưa mọi tác vụ về chu kỳ gốc và chạy ngay ở tick kế tiếp"""
+        for task in self._schedule:
+            task[2] = task[1]
+            task[3] = 0
 
     # --------------------------
     # UI LAYOUT
@@ -430,11 +530,14 @@ class LayerA_PLC(QWidget):
         baud = int(self.combo_baud.currentText())
         try:
             self.ser = serial.Serial(port, baudrate=baud, timeout=SERIAL_TIMEOUT)
+            self.t35 = t35_seconds(baud)
+            self._needs_resync = True
             time.sleep(0.1)
             self.lbl_serial_status.setText("Connected")
             self.lbl_serial_status.setStyleSheet("font-weight:bold; font-size:11pt; color:#27ae60;")
             self.btn_connect.setEnabled(False)
             self.btn_disconnect.setEnabled(True)
+            self._reset_schedule()
             self.log(f"RS485 connected on {port} @ {baud}")
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Cannot connect:\n{e}")
@@ -458,81 +561,85 @@ class LayerA_PLC(QWidget):
             return b""
         with self.ser_lock:
             try:
-                self.ser.reset_input_buffer()
+                if self._needs_resync:
+                    self.ser.reset_input_buffer()
+                time.sleep(self.t35)  # Khoảng lặng giữa frame trước và frame này
                 self.ser.write(frame)
                 self.ser.flush()
-                time.sleep(0.02)
-
-                resp = b""
-                start = time.time()
-                while time.time() - start < SERIAL_TIMEOUT:
-                    chunk = self.ser.read(256)
-                    if chunk:
-                        resp += chunk
-                        time.sleep(0.03)
-                    else:
-                        if resp:
-                            break
-                        time.sleep(0.01)
+                resp = read_rtu_response(self.ser)
+                self._needs_resync = not verify_crc(resp)
                 return resp
             except Exception as e:
+                self._needs_resync = True
                 self.log(f"Serial error: {e}")
                 return b""
 
     # --------------------------
     # READ DEVICES
     # --------------------------
-    def read_all_devices(self):
-        # Đọc vị trí hiện tại
-        frame = build_fc03(SLAVE_ID_DRIVER, 0x1000, 2)
-        resp = self.send_frame(frame)
-        if len(resp) >= 9 and resp[1] == 0x03 and verify_crc(resp):
-            try:
+    def read_all_devices(self) -> bool:
+        """Đọc toàn bộ thiết bị; trả về False nếu không thiết bị nào phản hồi"""
+        any_ok = False
+
+        if BATCH_DRIVE_READS:
+            # Một FC03 0x1000..0x1010 (17 reg): vị trí ở reg 0-1, status ở reg 16
+            frame = build_fc03(SLAVE_ID_DRIVER, 0x1000, 0x11)
+            resp = self.send_frame(frame)
+            if len(resp) >= 39 and resp[1] == 0x03 and verify_crc(resp):
+                any_ok = True
                 self.current_position = unpack_s32_from_bytes(resp, 3)
-            except:
-                pass
-
-        time.sleep(0.01)
-
-        # Đọc status driver
-        frame = build_fc03(SLAVE_ID_DRIVER, 0x1010, 1)
-        resp = self.send_frame(frame)
-        if len(resp) >= 7 and resp[1] == 0x03 and verify_crc(resp):
-            sw = (resp[3] << 8) | resp[4]
-            self.driver_alarm = bool((sw >> 8) & 0x01)
-            self.driver_inpos = bool((sw >> 4) & 0x01)
-            self.driver_running = bool((sw >> 2) & 0x01)
-
-        time.sleep(0.01)
+                self._decode_driver_status((resp[35] << 8) | resp[36])
+        else:
+            # Đọc vị trí hiện tại
+            frame = build_fc03(SLAVE_ID_DRIVER, 0x1000, 2)
+            resp = self.send_frame(frame)
+            if len(resp) >= 9 and resp[1] == 0x03 and verify_crc(resp):
+                any_ok = True
+                try:
+                    self.current_position = unpack_s32_from_bytes(resp, 3)
+                except:
+                    pass
+
+            # Đọc status driver
+            frame = build_fc03(SLAVE_ID_DRIVER, 0x1010, 1)
+            resp = self.send_frame(frame)
+            if len(resp) >= 7 and resp[1] == 0x03 and verify_crc(resp):
+                any_ok = True
+                self._decode_driver_status(unpack_regs(resp, 1)[0])
 
         # Đọc SHT20
         frame = build_fc04(SLAVE_ID_SHT20, 0x0001, 2)
         resp = self.send_frame(frame)
         if len(resp) >= 9 and resp[1] == 0x04 and verify_crc(resp):
+            any_ok = True
             try:
-                self.temperature = ((resp[3] << 8) | resp[4]) / 10.0
-                self.humidity = ((resp[5] << 8) | resp[6]) / 10.0
+                temp_raw, humi_raw = unpack_regs(resp, 2)
+                self.temperature = temp_raw / 10.0
+                self.humidity = humi_raw / 10.0
                 self.sht20_ok = True
             except:
                 self.sht20_ok = False
         else:
             self.sht20_ok = False
 
-        time.sleep(0.01)
-
         # Đọc Counter Arduino
         frame = build_fc03(SLAVE_ID_COUNTER, 0x0000, 4)
         resp = self.send_frame(frame)
         if len(resp) >= 13 and resp[1] == 0x03 and verify_crc(resp):
-            hr0 = (resp[3] << 8) | resp[4]
-            hr1 = (resp[5] << 8) | resp[6]
-            hr2 = (resp[7] << 8) | resp[8]
+            any_ok = True
+            hr0, hr1, hr2, _ = unpack_regs(resp, 4)
             self.counter_value = hr0
             self.counter_target = hr1
             self.counter_done = bool(hr2 & 0x0001)
 
         self.update_ui()
         self.update_input_registers()
+        return any_ok
+
+    def _decode_driver_status(self, sw: int):
+        self.driver_alarm = bool((sw >> 8) & 0x01)
+        self.driver_inpos = bool((sw >> 4) & 0x01)
+        self.driver_running = bool((sw >> 2) & 0x01)
 
     # --------------------------
     # CHECK TARGET FROM TCP
@@ -556,7 +663,9 @@ class LayerA_PLC(QWidget):
                 frame = build_fc06(SLAVE_ID_COUNTER, 0x0001, target)
                 resp = self.send_frame(frame)
 
-                if resp and len(resp) >= 8:
+                # Echo FC06 hợp lệ: đúng slave, đúng FC (không exception), CRC OK
+                if (resp and len(resp) >= 8 and resp[0] == SLAVE_ID_COUNTER
+                        and resp[1] == 0x06 and verify_crc(resp)):
                     self.log(f"Arduino nhận target = {target}")
                 else:
                     self.log("Arduino không confirm target")
@@ -729,7 +838,7 @@ class LayerA_PLC(QWidget):
             self.send_frame(frame)
             self.current_speed = AUTO_MOVE_SPEED
             self.motor_state = "Motor running"
-            self.last_motor_cmd_time = time.time()
+            self._last_motor_cmd_ns = time.monotonic_ns()
             self.log(
                 f"AUTO: count reached target "
                 f"({self.counter_value}/{self.counter_target}), "
@@ -749,9 +858,9 @@ class LayerA_PLC(QWidget):
                 frame = build_fc06(SLAVE_ID_COUNTER, 0x0003, 1)
                 self.send_frame(frame)
                 self.motor_state = "Waiting reset"
-                self.last_motor_cmd_time = time.time()
+                self._last_motor_cmd_ns = time.monotonic_ns()
                 self.log("AUTO: motor in-position, reset counter (HR3=1).")
-            elif time.time() - self.last_motor_cmd_time > 10:
+            elif time.monotonic_ns() - self._last_motor_cmd_ns > MOTOR_INPOS_TIMEOUT_NS:
                 # Quá 10 giây chưa InPos → lỗi timeout
                 self.motor_state = "Timeout motor"
                 self.log("AUTO: timeout waiting for motor InPos.")
@@ -863,13 +972,7 @@ class LayerA_PLC(QWidget):
             return
 
         try:
-            pos = self.current_position
-            if pos < 0:
-                pos_val = (1 << 32) + pos
-            else:
-                pos_val = pos
-            pos_hi = (pos_val >> 16) & 0xFFFF
-            pos_lo = pos_val & 0xFFFF
+            pos_hi, pos_lo = pack_s32(self.current_position)
 
             speed = max(0, min(int(self.current_speed), 0xFFFF))
             temp = max(-32768, min(int(self.temperature * 10), 32767)) & 0xFFFF
@@ -883,18 +986,7 @@ class LayerA_PLC(QWidget):
             if self.driver_running:
                 status_word |= 1 << 2
 
-            state_map = {
-                "Idle": 0,
-                "Waiting count": 1,
-                "Motor running": 2,
-                "Waiting reset": 3,
-                "Alarm": 4,
-                "Timeout motor": 5,
-                "Disabled": 6,
-                "Waiting target": 7,
-                "Manual": 8,
-            }
-            auto_code = state_map.get(self.motor_state, 0)
+            auto_code = AUTO_STATE_CODES.get(self.motor_state, 0)
 
             mode_val = 0
             try:
@@ -974,20 +1066,26 @@ class LayerA_PLC(QWidget):
 
     def closeEvent(self, event):
         self.running = False
-        self.timer_read.stop()
-        self.timer_auto.stop()
+        self.timer_sched.stop()
 
+        # Đóng serial và Modbus server song song trên thread daemon, chờ tối đa
+        # SHUTDOWN_TIMEOUT để GUI không bị treo nếu một lệnh close block I/O
+        closers = []
         if self.ser:
-            try:
-                self.ser.close()
-            except:
-                pass
-
+            closers.append(self.ser.close)
         if self.modbus_server:
-            try:
-                self.modbus_server.stop()
-            except:
-                pass
+            closers.append(self.modbus_server.stop)
+
+        threads = [
+            threading.Thread(target=_close_quietly, args=(fn,), daemon=True)
+            for fn in closers
+        ]
+        for t in threads:
+            t.start()
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
 
         event.accept()
 
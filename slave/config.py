@@ -55,11 +55,17 @@ DEVICE_DRIVE = {
     "incremental_register": 0x20,
 }
 
+# Đọc position + status bằng một FC03 (0x1000..0x1010).
+# Đặt False nếu driver từ chối đọc span dài → đọc riêng từng vùng.
+BATCH_DRIVE_READS = True
+# Hai vùng đọc cùng slave cách nhau ≤ POLL_MAX_GAP register thì gộp thành một FC03
+POLL_MAX_GAP = 16
+
 # ============================================================================
 # LOGGING CONFIGURATION
 # ============================================================================
 LOG_FILE = "logs/slave_monitor.log"
-LOG_MAX_LINES = 200
+LOG_MAX_LINES = 500  # Số dòng giữ trong log buffer và Event Log window
 LOG_FORMAT = "[%(asctime)s.%(msecs)03d] %(levelname)s %(component)s %(message)s"
 LOG_DATE_FORMAT = "%H:%M:%S"
 
@@ -68,5 +74,5 @@ LOG_DATE_FORMAT = "%H:%M:%S"
 # ============================================================================
 WINDOW_WIDTH = 1400
 WINDOW_HEIGHT = 900
-REFRESH_INTERVAL_MS = 500
-LOG_REFRESH_MS = 200
\ No newline at end of file
+LOG_REFRESH_MS = 200
+TXRX_REFRESH_MS = 200  # Nhịp tối đa vẽ lại nhãn TX/RX (frame giữa các lần vẽ bị bỏ qua)
\ No newline at end of file
@@ -1,10 +1,57 @@
 """
 Device Manager - Quản lý Sensor và Drive devices với pymodbus
 """
-from datetime import datetime
-from .modbus_handler import RS485Manager, ModbusTCPManager, DataParser
+import time
+import functools
+from collections import namedtuple
+from .modbus_handler import (
+    RS485Manager, ModbusTCPManager, DataParser, ErrorCode, coalesce_blocks, format_hms
+)
 from .logger_handler import logger
-from .config import DEVICE_SENSOR, DEVICE_DRIVE
+from .config import DEVICE_SENSOR, DEVICE_DRIVE, BATCH_DRIVE_READS
+
+
+# Snapshot trạng thái trả về cho GUI (truy cập theo thuộc tính, vd: st.ok);
+# data_text là chuỗi đã format sẵn để GUI setText trực tiếp
+DeviceStatus = namedtuple(
+    "DeviceStatus",
+    "name slave_id connected ok timeout err last_err last_read data data_text"
+)
+SystemStatus = namedtuple("SystemStatus", "modbus sensor drive")
+
+_YN = ("NO", "YES")
+
+
+def _notifies_change(method):
+    """Gọi device.on_change() sau khi thao tác kết thúc (kể cả khi lỗi)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            callback = self.on_change
+            if callback is not None:
+                callback()
+    return wrapper
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_status(status_word: int):
+    """Decode status word của driver → (alarm, inpos, running, last_data mẫu)
+
+    Status word lặp lại gần như mọi lần poll nên kết quả được cache;
+    dict trả về dùng chung, caller phải copy trước khi sửa.
+    """
+    alarm = bool(status_word & 0x8000)
+    inpos = bool(status_word & 0x0010)
+    running = bool(status_word & 0x0004)
+    data = {
+        "status_word": f"0x{status_word:04X}",
+        "alarm": _YN[alarm],
+        "in_position": _YN[inpos],
+        "running": _YN[running]
+    }
+    return alarm, inpos, running, data
 
 
 class ModbusDevice:
@@ -17,44 +64,77 @@ class ModbusDevice:
         
         # Status tracking
         self.is_connected = False
-        self.last_read_time = None
+        self._last_read_ns = 0  # monotonic; giờ hiển thị chỉ format trong get_status
         self.ok_count = 0
         self.timeout_count = 0
         self.error_count = 0
         self.last_error = ""
         self.last_data = {}
+        
+        # Cache cho get_status(): mọi lần đọc/ping đánh dấu dirty
+        self._status_dirty = True
+        self._cached_status = None
+        
+        # Callback không tham số, gọi sau mỗi thao tác Modbus (DeviceManager.set_listener)
+        self.on_change = None
     
+    @_notifies_change
     def ping(self) -> bool:
         """Ping device"""
-        logger.info(f"Pinging {self.name} (slave {self.slave_id})", "DEVICE")
+        self._status_dirty = True
+        logger.info("Pinging %s (slave %d)", "DEVICE", self.name, self.slave_id)
         success = self.manager.ping(self.slave_id)
         
         if success:
             self.is_connected = True
             self.ok_count += 1
             self.last_error = ""
-            logger.info(f"{self.name} OK", "DEVICE")
+            logger.info("%s OK", "DEVICE", self.name)
         else:
             self.is_connected = False
-            self.timeout_count += 1
-            self.last_error = "Ping timeout"
-            logger.warning(f"{self.name} Ping failed", "DEVICE")
+            self._count_failure()
+            self.last_error = self.manager.last_error or "Ping timeout"
+            logger.warning("%s Ping failed", "DEVICE", self.name)
         
         return success
     
-    def get_status(self) -> dict:
-        """Trả về status của device"""
-        return {
-            "name": self.name,
-            "slave_id": self.slave_id,
-            "connected": self.is_connected,
-            "ok_count": self.ok_count,
-            "timeout_count": self.timeout_count,
-            "error_count": self.error_count,
-            "last_error": self.last_error,
-            "last_read": self.last_read_time.strftime("%H:%M:%S") if self.last_read_time else "Never",
-            "data": self.last_data
-        }
+    def _count_failure(self):
+        """Tăng bộ đếm lỗi theo mã lỗi của transaction vừa thất bại"""
+        if self.manager.last_error_code == ErrorCode.TIMEOUT:
+            self.timeout_count += 1
+        else:
+            self.error_count += 1
+    
+    def ms_since_read(self):
+        """Số ms kể từ lần đọc thành công gần nhất (None nếu chưa đọc)"""
+        if not self._last_read_ns:
+            return None
+        return (time.monotonic_ns() - self._last_read_ns) // 1_000_000
+    
+    def get_status(self) -> DeviceStatus:
+        """Trả về status của device (cùng object nếu không có gì thay đổi)"""
+        if not self._status_dirty:
+            return self._cached_status
+        self._status_dirty = False
+        self._cached_status = DeviceStatus(
+            self.name,
+            self.slave_id,
+            self.is_connected,
+            self.ok_count,
+            self.timeout_count,
+            self.error_count,
+            self.last_error,
+            format_hms(self._last_read_ns) if self._last_read_ns else "Never",
+            self.last_data,
+            self._format_data()
+        )
+        return self._cached_status
+    
+    def _format_data(self) -> str:
+        """Chuỗi hiển thị last_data (chỉ gọi khi status thay đổi)"""
+        if not self.last_data:
+            return "---"
+        return " | ".join("%s: %s" % kv for kv in self.last_data.items())
 
 
 class SensorDevice(ModbusDevice):
@@ -66,45 +146,49 @@ class SensorDevice(ModbusDevice):
             DEVICE_SENSOR["slave_id"],
             manager
         )
+        self._start_reg = DEVICE_SENSOR["start_register"]
+        self._count = DEVICE_SENSOR["count"]
     
+    @_notifies_change
     def read(self) -> bool:
         """Đọc Temp + Humi từ SHT20"""
+        self._status_dirty = True
         result = self.manager.read_input_registers(
             self.slave_id,
-            DEVICE_SENSOR["start_register"],
-            DEVICE_SENSOR["count"]
+            self._start_reg,
+            self._count
         )
         
         if "error" in result:
-            self.timeout_count += 1
+            self._count_failure()
             self.last_error = result["error"]
             self.is_connected = False
-            logger.warning(f"{self.name} read failed: {self.last_error}", "SENSOR")
+            logger.warning("%s read failed: %s", "SENSOR", self.name, self.last_error)
             return False
         
         # Parse response
         parsed = DataParser.parse_sht20_response(result["registers"])
         
-        if "error" in parsed:
+        if parsed is None:
             self.error_count += 1
-            self.last_error = parsed["error"]
-            logger.warning(f"{self.name} parse error: {parsed['error']}", "SENSOR")
+            self.last_error = "Insufficient registers"
+            logger.warning("%s parse error: %s", "SENSOR", self.name, self.last_error)
             return False
         
         # Success
         self.last_data = {
-            "temperature": f"{parsed['temperature_c']:.1f} °C",
-            "humidity": f"{parsed['humidity_percent']:.1f} %",
+            "temperature": f"{parsed.temperature_c:.1f} °C",
+            "humidity": f"{parsed.humidity_percent:.1f} %",
             "raw": parsed
         }
         self.is_connected = True
         self.ok_count += 1
-        self.last_read_time = datetime.now()
+        self._last_read_ns = time.monotonic_ns()
         self.last_error = ""
         
         logger.info(
-            f"Temp: {parsed['temperature_c']:.1f}°C, Humi: {parsed['humidity_percent']:.1f}%",
-            "SENSOR"
+            "Temp: %.1f°C, Humi: %.1f%%",
+            "SENSOR", parsed.temperature_c, parsed.humidity_percent
         )
         return True
 
@@ -118,190 +202,229 @@ class DriveDevice(ModbusDevice):
             DEVICE_DRIVE["slave_id"],
             manager
         )
+        self._status_reg = DEVICE_DRIVE["status_register"]
+        self._position_reg = DEVICE_DRIVE["position_register"]
+        # Vùng đọc gộp position + status (0x1000..0x1010) nếu hai vùng đủ gần;
+        # None → read_bulk đọc riêng từng vùng
+        blocks = coalesce_blocks([
+            (self.slave_id, self._position_reg, 2),
+            (self.slave_id, self._status_reg, 1),
+        ])
+        self._bulk_block = blocks[0][1:] if len(blocks) == 1 else None
+    
+    def _format_data(self) -> str:
+        """Status các field (trừ position) + position, cùng dạng với Drive tab"""
+        data = self.last_data
+        parts = " | ".join("%s: %s" % kv for kv in data.items() if kv[0] != "position")
+        return "Status: %s | Position: %s" % (parts or "---", data.get("position", "---"))
     
+    @_notifies_change
     def read_status(self) -> bool:
         """Đọc status từ driver"""
+        self._status_dirty = True
         result = self.manager.read_holding_registers(
             self.slave_id,
-            DEVICE_DRIVE["status_register"],
+            self._status_reg,
             1
         )
         
         if "error" in result:
-            self.timeout_count += 1
+            self._count_failure()
             self.last_error = result["error"]
             self.is_connected = False
-            logger.warning(f"{self.name} status read failed", "DRIVE")
+            logger.warning("%s status read failed", "DRIVE", self.name)
             return False
         
         # Decode status word
-        if len(result.get("registers", [])) > 0:
-            status_word = result["registers"][0]
-            alarm = bool(status_word & 0x8000)
-            inpos = bool(status_word & 0x0010)
-            running = bool(status_word & 0x0004)
-            
-            self.last_data = {
-                "status_word": f"0x{status_word:04X}",
-                "alarm": "YES" if alarm else "NO",
-                "in_position": "YES" if inpos else "NO",
-                "running": "YES" if running else "NO"
-            }
-            self.is_connected = True
-            self.ok_count += 1
-            self.last_read_time = datetime.now()
-            self.last_error = ""
-            
-            logger.info(
-                f"Status: Alarm={alarm}, InPos={inpos}, Running={running}",
-                "DRIVE"
-            )
+        if result.get("registers"):
+            self._apply_status(result["registers"][0])
             return True
         
         return False
     
+    def _apply_status(self, status_word: int):
+        """Decode status word vào last_data và cập nhật trạng thái kết nối"""
+        alarm, inpos, running, data = _decode_status(status_word)
+        
+        self.last_data = data.copy()  # read_position ghi thêm "position" vào đây
+        self.is_connected = True
+        self.ok_count += 1
+        self._last_read_ns = time.monotonic_ns()
+        self.last_error = ""
+        
+        logger.info(
+            "Status: Alarm=%s, InPos=%s, Running=%s",
+            "DRIVE", alarm, inpos, running
+        )
+    
+    @_notifies_change
+    def read_bulk(self) -> bool:
+        """Đọc position + status trong một FC03 (0x1000..0x1010)"""
+        self._status_dirty = True
+        if not BATCH_DRIVE_READS or self._bulk_block is None:
+            return self.read_status() and self.read_position()
+        
+        start, count = self._bulk_block
+        result = self.manager.read_holding_registers(self.slave_id, start, count)
+        
+        if "error" in result:
+            self._count_failure()
+            self.last_error = result["error"]
+            self.is_connected = False
+            logger.warning("%s bulk read failed", "DRIVE", self.name)
+            return False
+        
+        registers = result.get("registers", [])
+        if len(registers) < count:
+            self.error_count += 1
+            self.last_error = "Insufficient registers"
+            logger.warning("%s bulk read parse error", "DRIVE", self.name)
+            return False
+        
+        pos_idx = self._position_reg - start
+        self._apply_status(registers[self._status_reg - start])
+        pos = DataParser.parse_position_registers(registers[pos_idx:pos_idx + 2])
+        self.last_data["position"] = f"{pos:,} pulse"
+        logger.debug("Position: %d pulse", "DRIVE", pos)
+        return True
+    
+    @_notifies_change
     def read_position(self) -> bool:
         """Đọc vị trí hiện tại"""
+        self._status_dirty = True
         result = self.manager.read_holding_registers(
             self.slave_id,
-            DEVICE_DRIVE["position_register"],
+            self._position_reg,
             2
         )
         
         if "error" in result:
             self.last_error = result["error"]
-            logger.warning(f"{self.name} position read failed", "DRIVE")
+            logger.warning("%s position read failed", "DRIVE", self.name)
             return False
         
         if len(result.get("registers", [])) < 2:
             self.last_error = "Insufficient registers"
-            logger.warning(f"{self.name} position parse error", "DRIVE")
+            logger.warning("%s position parse error", "DRIVE", self.name)
             return False
         
         # Combine 2 registers into 32-bit signed
         pos = DataParser.parse_position_registers(result["registers"])
         
         self.last_data["position"] = f"{pos:,} pulse"
-        logger.debug(f"Position: {pos} pulse", "DRIVE")
+        logger.debug("Position: %d pulse", "DRIVE", pos)
         return True
     
+    @_notifies_change
     def step_on(self) -> bool:
         """Bật motor"""
         success = self.manager.write_register(self.slave_id, 0x0000, 1)
         
         if success:
-            logger.info(f"{self.name} Step ON", "DRIVE")
+            logger.info("%s Step ON", "DRIVE", self.name)
         else:
-            logger.warning(f"{self.name} Step ON failed", "DRIVE")
+            logger.warning("%s Step ON failed", "DRIVE", self.name)
         
         return success
     
+    @_notifies_change
     def step_off(self) -> bool:
         """Tắt motor"""
         success = self.manager.write_register(self.slave_id, 0x0000, 0)
         
         if success:
-            logger.info(f"{self.name} Step OFF", "DRIVE")
+            logger.info("%s Step OFF", "DRIVE", self.name)
         else:
-            logger.warning(f"{self.name} Step OFF failed", "DRIVE")
+            logger.warning("%s Step OFF failed", "DRIVE", self.name)
         
         return success
     
+    @_notifies_change
     def reset_alarm(self) -> bool:
         """Reset alarm"""
         success = self.manager.write_register(self.slave_id, 0x0001, 1)
         
         if success:
-            logger.info(f"{self.name} Reset Alarm", "DRIVE")
+            logger.info("%s Reset Alarm", "DRIVE", self.name)
         else:
-            logger.warning(f"{self.name} Reset Alarm failed", "DRIVE")
+            logger.warning("%s Reset Alarm failed", "DRIVE", self.name)
         
         return success
     
+    @_notifies_change
     def move_stop(self) -> bool:
         """Dừng chuyển động"""
         success = self.manager.write_register(self.slave_id, 0x0002, 1)
         
         if success:
-            logger.info(f"{self.name} Stop", "DRIVE")
+            logger.info("%s Stop", "DRIVE", self.name)
         else:
-            logger.warning(f"{self.name} Stop failed", "DRIVE")
+            logger.warning("%s Stop failed", "DRIVE", self.name)
         
         return success
     
+    @_notifies_change
     def jog_cw(self, speed_pps: int) -> bool:
         """JOG chiều CW"""
-        try:
-            speed_regs = DataParser.pack_u32_to_regs(speed_pps)
-            registers = speed_regs + [0, 1]  # direction=1 (CW)
-            
-            success = self.manager.write_registers(self.slave_id, 0x30, registers)
-            
-            if success:
-                logger.info(f"{self.name} JOG CW @ {speed_pps} pps", "DRIVE")
-            else:
-                logger.warning(f"{self.name} JOG CW failed", "DRIVE")
-            
-            return success
-        except Exception as e:
-            logger.error(f"JOG CW error: {e}", "DRIVE")
-            return False
+        speed_pps = int(speed_pps)
+        registers = DataParser.pack_u32_to_regs(speed_pps) + [0, 1]  # direction=1 (CW)
+        
+        # write_registers tự bắt lỗi I/O và trả về False
+        success = self.manager.write_registers(self.slave_id, 0x30, registers)
+        
+        if success:
+            logger.info("%s JOG CW @ %d pps", "DRIVE", self.name, speed_pps)
+        else:
+            logger.warning("%s JOG CW failed", "DRIVE", self.name)
+        
+        return success
     
+    @_notifies_change
     def jog_ccw(self, speed_pps: int) -> bool:
         """JOG chiều CCW"""
-        try:
-            speed_regs = DataParser.pack_u32_to_regs(speed_pps)
-            registers = speed_regs + [0, 0]  # direction=0 (CCW)
-            
-            success = self.manager.write_registers(self.slave_id, 0x30, registers)
-            
-            if success:
-                logger.info(f"{self.name} JOG CCW @ {speed_pps} pps", "DRIVE")
-            else:
-                logger.warning(f"{self.name} JOG CCW failed", "DRIVE")
-            
-            return success
-        except Exception as e:
-            logger.error(f"JOG CCW error: {e}", "DRIVE")
-            return False
+        speed_pps = int(speed_pps)
+        registers = DataParser.pack_u32_to_regs(speed_pps) + [0, 0]  # direction=0 (CCW)
+        
+        success = self.manager.write_registers(self.slave_id, 0x30, registers)
+        
+        if success:
+            logger.info("%s JOG CCW @ %d pps", "DRIVE", self.name, speed_pps)
+        else:
+            logger.warning("%s JOG CCW failed", "DRIVE", self.name)
+        
+        return success
     
+    @_notifies_change
     def move_absolute(self, position: int, speed_pps: int) -> bool:
         """Move đến vị trí tuyệt đối"""
-        try:
-            pos_regs = DataParser.pack_s32_to_regs(position)
-            speed_regs = DataParser.pack_u32_to_regs(speed_pps)
-            registers = pos_regs + speed_regs
-            
-            success = self.manager.write_registers(self.slave_id, 0x10, registers)
-            
-            if success:
-                logger.info(f"{self.name} Move Absolute: pos={position}, speed={speed_pps} pps", "DRIVE")
-            else:
-                logger.warning(f"{self.name} Move Absolute failed", "DRIVE")
-            
-            return success
-        except Exception as e:
-            logger.error(f"Move Absolute error: {e}", "DRIVE")
-            return False
+        position = int(position)
+        speed_pps = int(speed_pps)
+        registers = DataParser.pack_s32_to_regs(position) + DataParser.pack_u32_to_regs(speed_pps)
+        
+        success = self.manager.write_registers(self.slave_id, 0x10, registers)
+        
+        if success:
+            logger.info("%s Move Absolute: pos=%d, speed=%d pps", "DRIVE", self.name, position, speed_pps)
+        else:
+            logger.warning("%s Move Absolute failed", "DRIVE", self.name)
+        
+        return success
     
+    @_notifies_change
     def move_incremental(self, offset: int, speed_pps: int) -> bool:
         """Move tương đối (incremental)"""
-        try:
-            pos_regs = DataParser.pack_s32_to_regs(offset)
-            speed_regs = DataParser.pack_u32_to_regs(speed_pps)
-            registers = pos_regs + speed_regs
-            
-            success = self.manager.write_registers(self.slave_id, 0x20, registers)
-            
-            if success:
-                logger.info(f"{self.name} Move Incremental: offset={offset}, speed={speed_pps} pps", "DRIVE")
-            else:
-                logger.warning(f"{self.name} Move Incremental failed", "DRIVE")
-            
-            return success
-        except Exception as e:
-            logger.error(f"Move Incremental error: {e}", "DRIVE")
-            return False
+        offset = int(offset)
+        speed_pps = int(speed_pps)
+        registers = DataParser.pack_s32_to_regs(offset) + DataParser.pack_u32_to_regs(speed_pps)
+        
+        success = self.manager.write_registers(self.slave_id, 0x20, registers)
+        
+        if success:
+            logger.info("%s Move Incremental: offset=%d, speed=%d pps", "DRIVE", self.name, offset, speed_pps)
+        else:
+            logger.warning("%s Move Incremental failed", "DRIVE", self.name)
+        
+        return success
 
 
 class DeviceManager:
@@ -311,11 +434,22 @@ class DeviceManager:
         self.manager = manager
         self.sensor = SensorDevice(manager)
         self.drive = DriveDevice(manager)
+        self._cached_all = None
     
-    def get_all_status(self) -> dict:
-        """Lấy status tất cả devices"""
-        return {
-            "modbus": self.manager.get_stats(),
-            "sensor": self.sensor.get_status(),
-            "drive": self.drive.get_status()
-        }
+    def set_listener(self, callback):
+        """Đăng ký callback (không tham số) gọi sau mỗi thao tác trên sensor/drive.
+        Có thể được gọi từ thread chạy thao tác - callback phải tự chuyển thread."""
+        self.sensor.on_change = callback
+        self.drive.on_change = callback
+    
+    def get_all_status(self) -> SystemStatus:
+        """Lấy status tất cả devices (cùng object nếu không có gì thay đổi)"""
+        modbus = self.manager.get_stats()
+        sensor = self.sensor.get_status()
+        drive = self.drive.get_status()
+        
+        cached = self._cached_all
+        if (cached is None or cached.modbus is not modbus
+                or cached.sensor is not sensor or cached.drive is not drive):
+            self._cached_all = SystemStatus(modbus, sensor, drive)
+        return self._cached_all
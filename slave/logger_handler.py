@@ -1,12 +1,18 @@
 """
 Logger Handler - Hệ thống logging tập trung với thread-safe queue
 """
+import atexit
 import logging
 import os
+import queue
+import time
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from datetime import datetime
 from collections import deque
 from threading import Lock
 
+from .config import LOG_MAX_LINES
+
 class ComponentFormatter(logging.Formatter):
     """Custom formatter hỗ trợ 'component' field"""
     def format(self, record):
@@ -15,19 +21,52 @@ class ComponentFormatter(logging.Formatter):
         return super().format(record)
 
 class LogBuffer:
-    """Thread-safe buffer lưu giữ log entries"""
+    """Thread-safe buffer lưu giữ log entries
+
+    add() không lấy lock: với CPython, deque.append (kể cả khi có maxlen) là
+    atomic dưới GIL nên các thread ghi log không phải chờ nhau. Lock chỉ
+    dùng giữa các thao tác đọc/xóa; snapshot bằng list() cũng là một lời gọi
+    C duy nhất nên không bị append chen giữa.
+
+    Mỗi entry lưu kèm số thứ tự (seq) tăng dần, không reset khi clear(), để
+    get_since() chỉ trả về các dòng mới. add() chỉ được gọi từ một thread
+    (thread QueueListener) nên seq không cần lock.
+    """
     def __init__(self, max_lines=200):
         self.max_lines = max_lines
         self.buffer = deque(maxlen=max_lines)
         self.lock = Lock()
+        self.seq = 0
     
-    def add(self, message: str):
-        with self.lock:
-            self.buffer.append(message)
+    def add(self, message: str) -> int:
+        """Thêm một dòng, trả về seq của dòng đó"""
+        seq = self.seq + 1
+        self.seq = seq
+        self.buffer.append((seq, message))
+        return seq
     
     def get_all(self):
         with self.lock:
-            return list(self.buffer)
+            entries = list(self.buffer)
+        return [message for _, message in entries]
+    
+    def get_recent(self, n: int):
+        """n dòng mới nhất (snapshot trước rồi mới cắt, không duyệt deque trực tiếp)"""
+        with self.lock:
+            entries = list(self.buffer)
+        return [message for _, message in entries[-n:]] if n > 0 else []
+    
+    def get_since(self, seq: int):
+        """Các dòng có seq > `seq` → (seq mới nhất, list dòng mới)"""
+        with self.lock:
+            entries = list(self.buffer)
+        if not entries:
+            return seq, []
+        last_seq = entries[-1][0]
+        count = min(last_seq - seq, len(entries))
+        if count <= 0:
+            return last_seq, []
+        return last_seq, [message for _, message in entries[-count:]]
     
     def clear(self):
         with self.lock:
@@ -35,30 +74,34 @@ class LogBuffer:
     
     def export_csv(self, filename: str):
         """Export log entries to CSV format"""
-        with self.lock:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write("Timestamp,Level,Component,Message\n")
-                for entry in self.buffer:
-                    f.write(entry + "\n")
+        entries = self.get_all()
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write("Timestamp,Level,Component,Message\n")
+            if entries:
+                f.write("\n".join(entries))
+                f.write("\n")
+
+# extra={"component": ...} dùng chung cho mỗi component thay vì tạo dict mới mỗi lần log
+_EXTRA_CACHE = {}
+
+
+def _extra(component: str) -> dict:
+    extra = _EXTRA_CACHE.get(component)
+    if extra is None:
+        extra = _EXTRA_CACHE.setdefault(component, {"component": component})
+    return extra
+
 
 class SlaveLogger:
-    """Logger singleton cho toàn hệ thống"""
-    _instance = None
-    _lock = Lock()
-    
-    def __new__(cls):
-        if cls._instance is None:
-            with cls._lock:
-                if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-        return cls._instance
-    
+    """Logger cho toàn hệ thống - dùng instance `logger` ở cuối module,
+    không tạo thêm SlaveLogger (mỗi instance gắn thêm handler vào cùng logger).
+
+    Các hàm info/warning/error/debug nhận tham số định dạng kiểu %-style sau
+    component, vd: logger.info("Temp: %.1f", "SENSOR", t). Chuỗi chỉ được
+    format khi record thực sự được handler chấp nhận.
+    """
     def __init__(self):
-        if hasattr(self, '_initialized'):
-            return
-        self._initialized = True
-        
-        self.log_buffer = LogBuffer(max_lines=200)
+        self.log_buffer = LogBuffer(max_lines=LOG_MAX_LINES)
         self.logger = logging.getLogger("SlaveMonitor")
         self.logger.setLevel(logging.DEBUG)
         
@@ -71,15 +114,31 @@ class SlaveLogger:
         
         # Handler: Custom buffer cho UI
         class BufferHandler(logging.Handler):
+            """Tự dựng dòng log (cùng định dạng với file) thay vì gọi Formatter;
+            phần HH:MM:SS chỉ strftime lại khi sang giây mới"""
             def __init__(self, buffer):
                 super().__init__()
                 self.buffer = buffer
+                self.callback = None  # callback(seq, line), gán qua set_line_callback()
+                self._sec = None
+                self._hms = ""
             
             def emit(self, record):
-                msg = self.format(record)
-                self.buffer.add(msg)
+                sec = int(record.created)
+                if sec != self._sec:
+                    self._sec = sec
+                    self._hms = time.strftime("%H:%M:%S", time.localtime(sec))
+                line = "[%s.%03d] %-5s [%s] %s" % (
+                    self._hms, record.msecs, record.levelname,
+                    getattr(record, "component", "SYSTEM"), record.getMessage()
+                )
+                seq = self.buffer.add(line)
+                callback = self.callback
+                if callback is not None:
+                    callback(seq, line)
         
         bh = BufferHandler(self.log_buffer)
+        self._buffer_handler = bh
         bh.setLevel(logging.DEBUG)
         
         # Formatter
@@ -89,31 +148,72 @@ class SlaveLogger:
         )
         
         fh.setFormatter(fmt)
-        bh.setFormatter(fmt)
         
-        self.logger.addHandler(fh)
-        self.logger.addHandler(bh)
+        # Gom record ghi file theo lô: chỉ flush khi đầy 256 dòng hoặc gặp ERROR
+        self._file_buffer = MemoryHandler(256, flushLevel=logging.ERROR, target=fh)
+        
+        # Thread gọi log chỉ đẩy record vào queue; ghi file + buffer UI chạy
+        # trên thread riêng của QueueListener → không chặn vòng poll Modbus
+        self._log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(self._log_queue))
+        self._listener = QueueListener(
+            self._log_queue, self._file_buffer, bh, respect_handler_level=True
+        )
+        self._listener.start()
+        atexit.register(self.stop)
+        
+        # Cờ cache cho đường debug nóng, cập nhật qua set_level()
+        self.debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
+    
+    def stop(self):
+        """Dừng listener, ghi nốt các record còn trong queue"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self.flush_file()
     
-    def info(self, msg: str, component: str = "SYSTEM"):
-        extra = {"component": component}
-        self.logger.info(msg, extra=extra)
+    def flush_file(self):
+        """Ghi ngay các record đang gom trong bộ đệm xuống file log"""
+        self._file_buffer.flush()
     
-    def warning(self, msg: str, component: str = "SYSTEM"):
-        extra = {"component": component}
-        self.logger.warning(msg, extra=extra)
+    def set_level(self, level):
+        """Đổi level của logger và cập nhật cờ debug_enabled"""
+        self.logger.setLevel(level)
+        self.debug_enabled = self.logger.isEnabledFor(logging.DEBUG)
     
-    def error(self, msg: str, component: str = "SYSTEM"):
-        extra = {"component": component}
-        self.logger.error(msg, extra=extra)
+    def info(self, msg: str, component: str = "SYSTEM", *args):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        self.logger.info(msg, *args, extra=_extra(component))
+    
+    def warning(self, msg: str, component: str = "SYSTEM", *args):
+        self.logger.warning(msg, *args, extra=_extra(component))
     
-    def debug(self, msg: str, component: str = "SYSTEM"):
-        extra = {"component": component}
-        self.logger.debug(msg, extra=extra)
+    def error(self, msg: str, component: str = "SYSTEM", *args):
+        self.logger.error(msg, *args, extra=_extra(component))
+    
+    def debug(self, msg: str, component: str = "SYSTEM", *args):
+        if not self.debug_enabled:
+            return
+        self.logger.debug(msg, *args, extra=_extra(component))
+    
+    def set_line_callback(self, callback):
+        """Đăng ký callback(seq, line) nhận từng dòng log mới để UI không phải
+        poll get_buffer(); chạy trên thread của QueueListener. None để gỡ"""
+        self._buffer_handler.callback = callback
     
     def get_buffer(self):
         """Lấy tất cả log entries"""
         return self.log_buffer.get_all()
     
+    def get_recent(self, n: int):
+        """n dòng log mới nhất"""
+        return self.log_buffer.get_recent(n)
+    
+    def get_since(self, seq: int):
+        """Các dòng log mới hơn `seq` → (seq mới nhất, list dòng)"""
+        return self.log_buffer.get_since(seq)
+    
     def clear_buffer(self):
         """Xóa log buffer"""
         self.log_buffer.clear()
@@ -121,7 +221,8 @@ class SlaveLogger:
     def export_csv(self, filename: str):
         """Export logs to CSV"""
         self.log_buffer.export_csv(filename)
+        self.flush_file()
         self.info(f"Logs exported to {filename}", "LOGGER")
 
-# Singleton instance
+# Instance dùng chung, khởi tạo một lần khi import
 logger = SlaveLogger()
\ No newline at end of file
@@ -7,25 +7,79 @@ import time
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QPushButton, QLabel, QComboBox, QSpinBox, QGroupBox, QTextEdit,
+    QPushButton, QLabel, QComboBox, QSpinBox, QGroupBox, QPlainTextEdit,
     QTabWidget, QFrame, QMessageBox, QLineEdit, QDoubleSpinBox
 )
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QObject
-from PyQt5.QtGui import QFont, QColor
+from PyQt5.QtCore import (
+    Qt, QTimer, QEvent, pyqtSignal, pyqtSlot, QObject, QRunnable, QThreadPool, QMetaObject, Q_ARG,
+    QSignalBlocker
+)
+from PyQt5.QtGui import QFont, QColor, QPalette, QTextCursor
 
 from .config import *
-from .modbus_handler import RS485Manager, ModbusTCPManager, ModbusFrame, ModbusTCPFrame
+from .modbus_handler import RS485Manager, ModbusTCPManager
 from .device_manager import DeviceManager
 from .logger_handler import logger
-from .modbus_tcp_server import ModbusTCPServer
 
-class SignalEmitter(QObject):
-    """Helper class để emit signals từ threads"""
-    update_signal = pyqtSignal()
+# Danh sách hiển thị trong combo, stringify một lần khi import
+_BAUD_STRS = tuple(str(b) for b in AVAILABLE_BAUDRATES)
+_STOPBIT_STRS = tuple(str(s) for s in AVAILABLE_STOPBITS)
+
+# Stylesheet của nhãn trạng thái kết nối (lbl_status)
+STYLE_STATUS_CLOSED = "background-color: #ffffcc; padding: 8px; font-size: 11pt; font-weight: bold;"
+STYLE_STATUS_CONN = "background-color: #90EE90; padding: 8px; font-size: 11pt; font-weight: bold;"
+STYLE_STATUS_FAIL = "background-color: #FFB6C1; padding: 8px; font-size: 11pt; font-weight: bold;"
+
+# Style tĩnh của toàn app, gắn theo objectName - Qt chỉ parse một lần trong main()
+# thay vì setStyleSheet() riêng cho từng widget. Màu đổi động vẫn dùng hằng ở trên.
+APP_STYLESHEET = """
+#logText { background-color: #f5f5f5; color: #333; }
+#btnOpen { background-color: #90EE90; font-weight: bold; padding: 8px; }
+#btnClose { background-color: #FFB6C1; font-weight: bold; padding: 8px; }
+#btnEventLog { background-color: #87CEEB; font-weight: bold; padding: 8px; }
+#sensorTx, #sensorRx, #driveTx, #driveRx { font-family: Courier; font-size: 9pt; }
+#sensorTx { background-color: #e8f5e9; }
+#sensorRx { background-color: #c8e6c9; }
+#driveTx { background-color: #fff3e0; }
+#driveRx { background-color: #ffe0b2; }
+#counters QLabel, #lastRead { font-size: 10pt; }
+#sensorTemp { font-size: 13pt; font-weight: bold; color: #FF4500; }
+#sensorHumi { font-size: 13pt; font-weight: bold; color: #1E90FF; }
+#driveInfo { font-size: 11pt; font-weight: bold; }
+#btnStepOn { background-color: #90EE90; font-weight: bold; }
+#btnStepOff { background-color: #FFB6C1; font-weight: bold; }
+#btnStop { background-color: #FF6B6B; font-weight: bold; }
+#btnReset { background-color: #FFA500; font-weight: bold; }
+#btnJog { background-color: #87CEEB; }
+"""
+
+class _OpenConnectionSignals(QObject):
+    """Signal báo kết quả open() về GUI thread: (ok, thông báo lỗi)"""
+    finished = pyqtSignal(bool, str)
+
+class _OpenConnectionTask(QRunnable):
+    """Gọi manager.open() trên QThreadPool - mở COM/TCP có thể chặn hàng trăm ms"""
+    
+    def __init__(self, manager):
+        super().__init__()
+        self.manager = manager
+        self.signals = _OpenConnectionSignals()
+    
+    def run(self):
+        try:
+            ok = self.manager.open()
+            error = "" if ok else self.manager.last_error
+        except Exception as e:
+            ok, error = False, str(e)
+        self.signals.finished.emit(ok, error)
 
 class EventLogWindow(QMainWindow):
     """Floating Event Log window"""
     
+    # Font dùng chung cho mọi instance; tạo ở lần khởi tạo đầu tiên
+    # (QFont cần QApplication đã tồn tại nên không tạo lúc import)
+    _LOG_FONT = None
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("📋 Event Log Monitor")
@@ -52,21 +106,60 @@ class EventLogWindow(QMainWindow):
         row.addStretch()
         layout.addLayout(row)
         
-        # Log text
-        self.log_text = QTextEdit()
+        # Log text - QPlainTextEdit tự bỏ dòng cũ khi vượt maximumBlockCount
+        self.log_text = QPlainTextEdit()
         self.log_text.setReadOnly(True)
-        self.log_text.setFont(QFont("Courier New", 8))
-        self.log_text.setStyleSheet("background-color: #f5f5f5; color: #333;")
+        self.log_text.setMaximumBlockCount(LOG_MAX_LINES)  # Cùng cỡ với log buffer
+        self.log_text.document().setUndoRedoEnabled(False)  # Log không cần undo stack
+        if EventLogWindow._LOG_FONT is None:
+            EventLogWindow._LOG_FONT = QFont("Courier New", 8)
+        self.log_text.setFont(self._LOG_FONT)
+        self.log_text.setObjectName("logText")
         layout.addWidget(self.log_text)
         
         central.setLayout(layout)
         self.setCentralWidget(central)
+        
+        # Số thứ tự (seq) của dòng log cuối cùng đã hiển thị
+        self._log_seq = 0
     
-    def update_log(self, log_entries):
-        """Update log display"""
-        self.log_text.setPlainText("\n".join(log_entries[-100:]))  # Last 100 lines
+    @pyqtSlot(int, str)
+    def append_line(self, seq, line):
+        """Append một dòng log (gọi queued từ thread của logger)"""
+        if seq <= self._log_seq or not self.isVisible():
+            return  # Đã có từ lần sync_log(), hoặc cửa sổ ẩn (showEvent sẽ sync)
+        self._log_seq = seq
+        self.log_text.appendPlainText(line)
         if self.auto_scroll.isChecked():
-            self.log_text.verticalScrollBar().setValue(self.log_text.verticalScrollBar().maximum())
+            self.scroll_to_end()
+    
+    def showEvent(self, event):
+        """Bù các dòng log phát sinh trong lúc cửa sổ ẩn"""
+        super().showEvent(event)
+        self.sync_log()
+    
+    def scroll_to_end(self):
+        """Đưa con trỏ về cuối log và cuộn tới đó"""
+        cursor = self.log_text.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        self.log_text.setTextCursor(cursor)
+        self.log_text.ensureCursorVisible()
+    
+    def sync_log(self):
+        """Append các dòng trong buffer mới hơn _log_seq vào cuối log display"""
+        self._log_seq, new_entries = logger.get_since(self._log_seq)
+        if not new_entries:
+            return
+        # Append cả lô: tắt repaint/signal trong lúc ghi, vẽ lại một lần ở cuối
+        self.log_text.setUpdatesEnabled(False)
+        self.log_text.blockSignals(True)
+        try:
+            self.log_text.appendPlainText("\n".join(new_entries))
+        finally:
+            self.log_text.blockSignals(False)
+            self.log_text.setUpdatesEnabled(True)
+        if self.auto_scroll.isChecked():
+            self.scroll_to_end()
     
     def on_clear(self):
         """Clear log"""
@@ -84,6 +177,9 @@ class EventLogWindow(QMainWindow):
 class SlaveMonitorGUI(QMainWindow):
     """Main application window"""
     
+    # Text nhãn kết nối, chọn bằng index bool(connected)
+    _CONN_STRS = ("Status: ❌ Disconnected", "Status: ✅ Connected")
+    
     def __init__(self):
         super().__init__()
         self.setWindowTitle("🔧 RS-485/Modbus Monitor & Control")
@@ -92,18 +188,47 @@ class SlaveMonitorGUI(QMainWindow):
         # Initialize components
         self.modbus_manager = None
         self.device_manager = None
-        self.log_window = None
-        self.emitter = SignalEmitter()
-        self.emitter.update_signal.connect(self.refresh_ui)
+        self._open_task = None  # _OpenConnectionTask đang chạy (giữ reference)
+        self._open_mode_str = ""
+        # refresh_ui luôn được queue về GUI thread; _refresh_pending gộp các
+        # yêu cầu dồn dập thành một lần refresh_ui (xem request_refresh)
+        self._refresh_pending = False
+        
+        # Log window tạo sẵn (ẩn) và nhận từng dòng log - logger gọi callback
+        # trên thread của nó, invokeMethod queue append_line về GUI thread
+        self.log_window = EventLogWindow()
+        logger.set_line_callback(self.post_log_line)
+        
+        # Cache phần đã hiển thị: chỉ vẽ lại khi status object đổi (get_all_status
+        # trả về cùng object nếu không có gì mới) và tab tương ứng đang mở
+        self._active_tab = 0
+        self._last_modbus = None
+        # TX/RX vẽ tối đa mỗi TXRX_REFRESH_MS: vẽ ngay nếu timer rảnh, còn lại
+        # để _repaint_txrx lấy snapshot mới nhất khi timer hết hạn
+        self._txrx_timer = QTimer(self)
+        self._txrx_timer.setSingleShot(True)
+        self._txrx_timer.setInterval(TXRX_REFRESH_MS)
+        self._txrx_timer.timeout.connect(self._repaint_txrx)
+        self._last_sensor = None
+        self._last_drive = None
+        self._sensor_prev_connected = None
+        self._drive_prev_connected = None
+        # Màu nhãn kết nối đổi bằng palette (không qua CSS), index bool(connected)
+        self._conn_palettes = []
+        for color in ("red", "green"):
+            pal = QPalette(self.palette())
+            pal.setColor(QPalette.WindowText, QColor(color))
+            self._conn_palettes.append(pal)
+        # Giá trị đã hiển thị: text theo id(label) (xem _set_text) và
+        # tuple bộ đếm theo nhóm, để bỏ qua setText/setNum khi không đổi
+        self._label_cache = {}
+        self._shown_sig = {}
+        # Nút lệnh device, chỉ bật khi đã kết nối - xem add_device_button
+        self._device_buttons = []
         
         # Setup UI
         self.init_ui()
         
-        # Timers
-        self.refresh_timer = QTimer()
-        self.refresh_timer.timeout.connect(self.refresh_ui)
-        self.refresh_timer.start(REFRESH_INTERVAL_MS)
-        
         logger.info("Application started", "UI")
     
     def init_ui(self):
@@ -111,26 +236,45 @@ class SlaveMonitorGUI(QMainWindow):
         central = QWidget()
         main_layout = QVBoxLayout()
         
-        # Tab widget
+        # Tab widget - Sensor/Drive chỉ dựng khi được mở lần đầu (on_tab_changed),
+        # trước đó là QWidget rỗng giữ chỗ
         tabs = QTabWidget()
+        self.tabs = tabs
+        self._tab_builders = {
+            1: (self.create_sensor_tab, "🌡 Sensor (SHT20)"),
+            2: (self.create_drive_tab, "⚙ Drive (EZi-STEP)"),
+        }
+        tabs.currentChanged.connect(self.on_tab_changed)
         
         # Tab 1: Connection Settings
         tabs.addTab(self.create_connection_tab(), "🔌 Connection Settings")
         
-        # Tab 2: Sensor Device
-        tabs.addTab(self.create_sensor_tab(), "🌡 Sensor (SHT20)")
-        
-        # Tab 3: Drive Device
-        tabs.addTab(self.create_drive_tab(), "⚙ Drive (EZi-STEP)")
+        # Tab 2: Sensor Device, Tab 3: Drive Device
+        for index in sorted(self._tab_builders):
+            tabs.addTab(QWidget(), self._tab_builders[index][1])
         
         main_layout.addWidget(tabs)
         
         central.setLayout(main_layout)
         self.setCentralWidget(central)
     
+    def on_tab_changed(self, index):
+        """Dựng tab nếu mở lần đầu, ghi nhận tab đang mở và vẽ ngay dữ liệu của tab đó"""
+        builder = self._tab_builders.pop(index, None)
+        if builder is not None:
+            create, title = builder
+            widget = create()
+            with QSignalBlocker(self.tabs):
+                self.tabs.removeTab(index)
+                self.tabs.insertTab(index, widget, title)
+                self.tabs.setCurrentIndex(index)
+        self._active_tab = index
+        self.refresh_ui()
+    
     def create_connection_tab(self):
         """Connection settings tab"""
         widget = QWidget()
+        widget.setUpdatesEnabled(False)  # Không repaint/relayout khi đang dựng tab
         layout = QVBoxLayout()
         
         # Group: Connection Mode
@@ -140,8 +284,9 @@ class SlaveMonitorGUI(QMainWindow):
         row = QHBoxLayout()
         row.addWidget(QLabel("Mode:"))
         self.combo_mode = QComboBox()
-        self.combo_mode.addItems(["Serial RS-485", "Modbus TCP/IP"])
-        self.combo_mode.setCurrentIndex(0 if CONNECTION_MODE == "SERIAL" else 1)
+        with QSignalBlocker(self.combo_mode):
+            self.combo_mode.addItems(["Serial RS-485", "Modbus TCP/IP"])
+            self.combo_mode.setCurrentIndex(0 if CONNECTION_MODE == "SERIAL" else 1)
         self.combo_mode.currentIndexChanged.connect(self.on_mode_changed)
         row.addWidget(self.combo_mode)
         row.addStretch()
@@ -157,8 +302,9 @@ class SlaveMonitorGUI(QMainWindow):
         row = QHBoxLayout()
         row.addWidget(QLabel("COM Port:"))
         self.combo_port = QComboBox()
-        self.combo_port.addItems(AVAILABLE_PORTS)
-        self.combo_port.setCurrentText(DEFAULT_COM_PORT)
+        with QSignalBlocker(self.combo_port):
+            self.combo_port.addItems(AVAILABLE_PORTS)
+            self.combo_port.setCurrentText(DEFAULT_COM_PORT)
         row.addWidget(self.combo_port)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -166,20 +312,23 @@ class SlaveMonitorGUI(QMainWindow):
         row = QHBoxLayout()
         row.addWidget(QLabel("Baudrate:"))
         self.combo_baud = QComboBox()
-        self.combo_baud.addItems([str(b) for b in AVAILABLE_BAUDRATES])
-        self.combo_baud.setCurrentText(str(DEFAULT_BAUDRATE))
+        with QSignalBlocker(self.combo_baud):
+            self.combo_baud.addItems(_BAUD_STRS)
+            self.combo_baud.setCurrentText(str(DEFAULT_BAUDRATE))
         row.addWidget(self.combo_baud)
         
         row.addWidget(QLabel("Parity:"))
         self.combo_parity = QComboBox()
-        self.combo_parity.addItems(AVAILABLE_PARITY)
-        self.combo_parity.setCurrentText(DEFAULT_PARITY)
+        with QSignalBlocker(self.combo_parity):
+            self.combo_parity.addItems(AVAILABLE_PARITY)
+            self.combo_parity.setCurrentText(DEFAULT_PARITY)
         row.addWidget(self.combo_parity)
         
         row.addWidget(QLabel("Stopbits:"))
         self.combo_stopbits = QComboBox()
-        self.combo_stopbits.addItems([str(s) for s in AVAILABLE_STOPBITS])
-        self.combo_stopbits.setCurrentText(str(DEFAULT_STOPBITS))
+        with QSignalBlocker(self.combo_stopbits):
+            self.combo_stopbits.addItems(_STOPBIT_STRS)
+            self.combo_stopbits.setCurrentText(str(DEFAULT_STOPBITS))
         row.addWidget(self.combo_stopbits)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -205,27 +354,30 @@ class SlaveMonitorGUI(QMainWindow):
         grp_tcp_layout.addLayout(row)
         
         self.grp_tcp.setLayout(grp_tcp_layout)
-        self.grp_tcp.setVisible(False)
         layout.addWidget(self.grp_tcp)
         
+        # combo_mode được chọn trong QSignalBlocker → tự áp dụng mode ban đầu
+        # sau khi cả hai group đã tồn tại
+        self.on_mode_changed(self.combo_mode.currentIndex())
+        
         # Group: Connection Actions
         grp_actions = QGroupBox("Connection Control")
         grp_layout = QVBoxLayout()
         
         row = QHBoxLayout()
         self.btn_open = QPushButton("🔓 Connect")
-        self.btn_open.setStyleSheet("background-color: #90EE90; font-weight: bold; padding: 8px;")
+        self.btn_open.setObjectName("btnOpen")
         self.btn_open.clicked.connect(self.on_open_connection)
         row.addWidget(self.btn_open)
         
         self.btn_close = QPushButton("🔒 Disconnect")
-        self.btn_close.setStyleSheet("background-color: #FFB6C1; font-weight: bold; padding: 8px;")
+        self.btn_close.setObjectName("btnClose")
         self.btn_close.setEnabled(False)
         self.btn_close.clicked.connect(self.on_close_connection)
         row.addWidget(self.btn_close)
         
         btn_event_log = QPushButton("📋 Event Log Window")
-        btn_event_log.setStyleSheet("background-color: #87CEEB; font-weight: bold; padding: 8px;")
+        btn_event_log.setObjectName("btnEventLog")
         btn_event_log.clicked.connect(self.on_open_event_log)
         row.addWidget(btn_event_log)
         
@@ -233,7 +385,7 @@ class SlaveMonitorGUI(QMainWindow):
         grp_layout.addLayout(row)
         
         self.lbl_status = QLabel("Status: DISCONNECTED")
-        self.lbl_status.setStyleSheet("background-color: #ffffcc; padding: 8px; font-size: 11pt; font-weight: bold;")
+        self.lbl_status.setStyleSheet(STYLE_STATUS_CLOSED)
         grp_layout.addWidget(self.lbl_status)
         
         grp_actions.setLayout(grp_layout)
@@ -247,14 +399,14 @@ class SlaveMonitorGUI(QMainWindow):
         row = QHBoxLayout()
         row.addWidget(QLabel("🌡 Sensor TX:"))
         self.lbl_sensor_tx = QLabel("---")
-        self.lbl_sensor_tx.setStyleSheet("background-color: #e8f5e9; font-family: Courier; font-size: 9pt;")
+        self.lbl_sensor_tx.setObjectName("sensorTx")
         row.addWidget(self.lbl_sensor_tx)
         grp_layout.addLayout(row)
         
         row = QHBoxLayout()
         row.addWidget(QLabel("🌡 Sensor RX:"))
         self.lbl_sensor_rx = QLabel("---")
-        self.lbl_sensor_rx.setStyleSheet("background-color: #c8e6c9; font-family: Courier; font-size: 9pt;")
+        self.lbl_sensor_rx.setObjectName("sensorRx")
         row.addWidget(self.lbl_sensor_rx)
         grp_layout.addLayout(row)
         
@@ -262,14 +414,14 @@ class SlaveMonitorGUI(QMainWindow):
         row = QHBoxLayout()
         row.addWidget(QLabel("⚙ Drive TX:"))
         self.lbl_drive_tx = QLabel("---")
-        self.lbl_drive_tx.setStyleSheet("background-color: #fff3e0; font-family: Courier; font-size: 9pt;")
+        self.lbl_drive_tx.setObjectName("driveTx")
         row.addWidget(self.lbl_drive_tx)
         grp_layout.addLayout(row)
         
         row = QHBoxLayout()
         row.addWidget(QLabel("⚙ Drive RX:"))
         self.lbl_drive_rx = QLabel("---")
-        self.lbl_drive_rx.setStyleSheet("background-color: #ffe0b2; font-family: Courier; font-size: 9pt;")
+        self.lbl_drive_rx.setObjectName("driveRx")
         row.addWidget(self.lbl_drive_rx)
         grp_layout.addLayout(row)
         
@@ -278,6 +430,7 @@ class SlaveMonitorGUI(QMainWindow):
         
         layout.addStretch()
         widget.setLayout(layout)
+        widget.setUpdatesEnabled(True)
         return widget
     
     def on_mode_changed(self, index):
@@ -286,55 +439,88 @@ class SlaveMonitorGUI(QMainWindow):
         self.grp_serial.setVisible(not is_tcp)
         self.grp_tcp.setVisible(is_tcp)
     
+    def create_conn_label(self):
+        """Nhãn trạng thái kết nối của device: font 11pt đậm, màu qua palette"""
+        lbl = QLabel(self._CONN_STRS[0])
+        font = lbl.font()
+        font.setPointSize(11)
+        font.setBold(True)
+        lbl.setFont(font)
+        lbl.setPalette(self._conn_palettes[0])
+        return lbl
+    
+    def create_counters_row(self):
+        """Hàng bộ đếm OK/Timeout/Error: nhãn tiêu đề tĩnh + một QLabel số cho
+        mỗi bộ đếm (cập nhật bằng setNum) → (widget, lbl_ok, lbl_timeout, lbl_err)"""
+        widget = QWidget()
+        widget.setObjectName("counters")
+        row = QHBoxLayout()
+        row.setContentsMargins(0, 0, 0, 0)
+        values = []
+        for i, title in enumerate(("OK:", "Timeout:", "Error:")):
+            if i:
+                row.addWidget(QLabel("|"))
+            row.addWidget(QLabel(title))
+            lbl = QLabel("0")
+            row.addWidget(lbl)
+            values.append(lbl)
+        row.addStretch()
+        widget.setLayout(row)
+        return (widget, *values)
+    
     def create_sensor_tab(self):
         """Sensor device tab"""
+        name, slave_id, start_reg = (
+            DEVICE_SENSOR["name"], DEVICE_SENSOR["slave_id"], DEVICE_SENSOR["start_register"]
+        )
         widget = QWidget()
         layout = QVBoxLayout()
         
-        grp = QGroupBox(f"📊 {DEVICE_SENSOR['name']}")
+        grp = QGroupBox(f"📊 {name}")
         grp_layout = QVBoxLayout()
         
         # Info
         row = QHBoxLayout()
-        row.addWidget(QLabel(f"Slave ID: {DEVICE_SENSOR['slave_id']}"))
-        row.addWidget(QLabel(f"Registers: 0x{DEVICE_SENSOR['start_register']:04X}"))
+        row.addWidget(QLabel(f"Slave ID: {slave_id}"))
+        row.addWidget(QLabel(f"Registers: 0x{start_reg:04X}"))
         row.addStretch()
         grp_layout.addLayout(row)
         
         # Status
-        self.lbl_sensor_status = QLabel("Status: ❌ Disconnected")
-        self.lbl_sensor_status.setStyleSheet("font-size: 11pt; font-weight: bold; color: red;")
+        self.lbl_sensor_status = self.create_conn_label()
         grp_layout.addWidget(self.lbl_sensor_status)
         
         self.lbl_sensor_last = QLabel("Last Read: Never")
-        self.lbl_sensor_last.setStyleSheet("font-size: 10pt;")
+        self.lbl_sensor_last.setObjectName("lastRead")
         grp_layout.addWidget(self.lbl_sensor_last)
         
         # Data display
         row = QHBoxLayout()
         self.lbl_sensor_temp = QLabel("Temp: --- °C")
-        self.lbl_sensor_temp.setStyleSheet("font-size: 13pt; font-weight: bold; color: #FF4500;")
+        self.lbl_sensor_temp.setObjectName("sensorTemp")
         row.addWidget(self.lbl_sensor_temp)
         
         self.lbl_sensor_humi = QLabel("Humi: --- %")
-        self.lbl_sensor_humi.setStyleSheet("font-size: 13pt; font-weight: bold; color: #1E90FF;")
+        self.lbl_sensor_humi.setObjectName("sensorHumi")
         row.addWidget(self.lbl_sensor_humi)
         row.addStretch()
         grp_layout.addLayout(row)
         
         # Counters
-        self.lbl_sensor_counters = QLabel("OK: 0 | Timeout: 0 | Error: 0")
-        self.lbl_sensor_counters.setStyleSheet("font-size: 10pt;")
-        grp_layout.addWidget(self.lbl_sensor_counters)
+        counters, self.lbl_sensor_ok, self.lbl_sensor_timeout, self.lbl_sensor_err = \
+            self.create_counters_row()
+        grp_layout.addWidget(counters)
         
         # Buttons
         row = QHBoxLayout()
         btn_ping = QPushButton("📡 Ping")
-        btn_ping.clicked.connect(lambda: self.device_manager and self.device_manager.sensor.ping())
+        btn_ping.clicked.connect(self.on_sensor_ping)
+        self.add_device_button(btn_ping)
         row.addWidget(btn_ping)
         
         btn_read = QPushButton("📖 Read")
-        btn_read.clicked.connect(lambda: self.device_manager and self.device_manager.sensor.read())
+        btn_read.clicked.connect(self.on_sensor_read)
+        self.add_device_button(btn_read)
         row.addWidget(btn_read)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -347,53 +533,58 @@ class SlaveMonitorGUI(QMainWindow):
     
     def create_drive_tab(self):
         """Drive device tab"""
+        name, slave_id, status_reg = (
+            DEVICE_DRIVE["name"], DEVICE_DRIVE["slave_id"], DEVICE_DRIVE["status_register"]
+        )
         widget = QWidget()
         layout = QVBoxLayout()
         
-        grp = QGroupBox(f"🎮 {DEVICE_DRIVE['name']}")
+        grp = QGroupBox(f"🎮 {name}")
         grp_layout = QVBoxLayout()
         
         # Info
         row = QHBoxLayout()
-        row.addWidget(QLabel(f"Slave ID: {DEVICE_DRIVE['slave_id']}"))
-        row.addWidget(QLabel(f"Status Reg: 0x{DEVICE_DRIVE['status_register']:04X}"))
+        row.addWidget(QLabel(f"Slave ID: {slave_id}"))
+        row.addWidget(QLabel(f"Status Reg: 0x{status_reg:04X}"))
         row.addStretch()
         grp_layout.addLayout(row)
         
         # Status
-        self.lbl_drive_status_text = QLabel("Status: ❌ Disconnected")
-        self.lbl_drive_status_text.setStyleSheet("font-size: 11pt; font-weight: bold; color: red;")
+        self.lbl_drive_status_text = self.create_conn_label()
         grp_layout.addWidget(self.lbl_drive_status_text)
         
         self.lbl_drive_last = QLabel("Last Read: Never")
-        self.lbl_drive_last.setStyleSheet("font-size: 10pt;")
+        self.lbl_drive_last.setObjectName("lastRead")
         grp_layout.addWidget(self.lbl_drive_last)
         
         # Data
         row = QHBoxLayout()
         self.lbl_drive_info = QLabel("Status: --- | Position: ---")
-        self.lbl_drive_info.setStyleSheet("font-size: 11pt; font-weight: bold;")
+        self.lbl_drive_info.setObjectName("driveInfo")
         row.addWidget(self.lbl_drive_info)
         row.addStretch()
         grp_layout.addLayout(row)
         
         # Counters
-        self.lbl_drive_counters = QLabel("OK: 0 | Timeout: 0 | Error: 0")
-        self.lbl_drive_counters.setStyleSheet("font-size: 10pt;")
-        grp_layout.addWidget(self.lbl_drive_counters)
+        counters, self.lbl_drive_ok, self.lbl_drive_timeout, self.lbl_drive_err = \
+            self.create_counters_row()
+        grp_layout.addWidget(counters)
         
         # Control buttons row 1
         row = QHBoxLayout()
         btn_ping = QPushButton("📡 Ping")
-        btn_ping.clicked.connect(lambda: self.device_manager and self.device_manager.drive.ping())
+        btn_ping.clicked.connect(self.on_drive_ping)
+        self.add_device_button(btn_ping)
         row.addWidget(btn_ping)
         
         btn_status = QPushButton("📖 Status")
-        btn_status.clicked.connect(lambda: self.device_manager and self.device_manager.drive.read_status())
+        btn_status.clicked.connect(self.on_drive_status)
+        self.add_device_button(btn_status)
         row.addWidget(btn_status)
         
         btn_pos = QPushButton("📍 Position")
-        btn_pos.clicked.connect(lambda: self.device_manager and self.device_manager.drive.read_position())
+        btn_pos.clicked.connect(self.on_drive_position)
+        self.add_device_button(btn_pos)
         row.addWidget(btn_pos)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -401,23 +592,27 @@ class SlaveMonitorGUI(QMainWindow):
         # Control buttons row 2 (ON/OFF/STOP)
         row = QHBoxLayout()
         btn_on = QPushButton("✓ Step ON")
-        btn_on.setStyleSheet("background-color: #90EE90; font-weight: bold;")
-        btn_on.clicked.connect(lambda: self.device_manager and self.device_manager.drive.step_on())
+        btn_on.setObjectName("btnStepOn")
+        btn_on.clicked.connect(self.on_step_on)
+        self.add_device_button(btn_on)
         row.addWidget(btn_on)
         
         btn_off = QPushButton("✗ Step OFF")
-        btn_off.setStyleSheet("background-color: #FFB6C1; font-weight: bold;")
-        btn_off.clicked.connect(lambda: self.device_manager and self.device_manager.drive.step_off())
+        btn_off.setObjectName("btnStepOff")
+        btn_off.clicked.connect(self.on_step_off)
+        self.add_device_button(btn_off)
         row.addWidget(btn_off)
         
         btn_stop = QPushButton("⏹ STOP")
-        btn_stop.setStyleSheet("background-color: #FF6B6B; font-weight: bold;")
-        btn_stop.clicked.connect(lambda: self.device_manager and self.device_manager.drive.move_stop())
+        btn_stop.setObjectName("btnStop")
+        btn_stop.clicked.connect(self.on_move_stop)
+        self.add_device_button(btn_stop)
         row.addWidget(btn_stop)
         
         btn_reset = QPushButton("⚠ Reset Alarm")
-        btn_reset.setStyleSheet("background-color: #FFA500; font-weight: bold;")
-        btn_reset.clicked.connect(lambda: self.device_manager and self.device_manager.drive.reset_alarm())
+        btn_reset.setObjectName("btnReset")
+        btn_reset.clicked.connect(self.on_reset_alarm)
+        self.add_device_button(btn_reset)
         row.addWidget(btn_reset)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -431,13 +626,15 @@ class SlaveMonitorGUI(QMainWindow):
         row.addWidget(self.spin_jog_speed)
         
         btn_jog_ccw = QPushButton("◀ JOG CCW")
-        btn_jog_ccw.setStyleSheet("background-color: #87CEEB;")
-        btn_jog_ccw.clicked.connect(lambda: self.device_manager and self.device_manager.drive.jog_ccw(self.spin_jog_speed.value()))
+        btn_jog_ccw.setObjectName("btnJog")
+        btn_jog_ccw.clicked.connect(self.on_jog_ccw)
+        self.add_device_button(btn_jog_ccw)
         row.addWidget(btn_jog_ccw)
         
         btn_jog_cw = QPushButton("JOG CW ▶")
-        btn_jog_cw.setStyleSheet("background-color: #87CEEB;")
-        btn_jog_cw.clicked.connect(lambda: self.device_manager and self.device_manager.drive.jog_cw(self.spin_jog_speed.value()))
+        btn_jog_cw.setObjectName("btnJog")
+        btn_jog_cw.clicked.connect(self.on_jog_cw)
+        self.add_device_button(btn_jog_cw)
         row.addWidget(btn_jog_cw)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -457,6 +654,7 @@ class SlaveMonitorGUI(QMainWindow):
         
         btn_abs = QPushButton("Move Absolute")
         btn_abs.clicked.connect(self.on_move_absolute)
+        self.add_device_button(btn_abs)
         row.addWidget(btn_abs)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -476,6 +674,7 @@ class SlaveMonitorGUI(QMainWindow):
         
         btn_inc = QPushButton("Move Incremental")
         btn_inc.clicked.connect(self.on_move_incremental)
+        self.add_device_button(btn_inc)
         row.addWidget(btn_inc)
         row.addStretch()
         grp_layout.addLayout(row)
@@ -486,30 +685,98 @@ class SlaveMonitorGUI(QMainWindow):
         widget.setLayout(layout)
         return widget
     
+    def add_device_button(self, button):
+        """Đăng ký nút lệnh device: chỉ bật khi đã kết nối (xem bind_device_buttons),
+        nên slot của nút không phải kiểm tra device_manager"""
+        self._device_buttons.append(button)
+        button.setEnabled(self.device_manager is not None)
+    
+    def bind_device_buttons(self):
+        """Bật/tắt các nút lệnh theo device_manager hiện tại, gọi khi kết nối/ngắt"""
+        enabled = self.device_manager is not None
+        for button in self._device_buttons:
+            button.setEnabled(enabled)
+    
+    @pyqtSlot()
+    def on_sensor_ping(self):
+        """Ping sensor"""
+        self.device_manager.sensor.ping()
+    
+    @pyqtSlot()
+    def on_sensor_read(self):
+        """Đọc nhiệt độ/độ ẩm"""
+        self.device_manager.sensor.read()
+    
+    @pyqtSlot()
+    def on_drive_ping(self):
+        """Ping driver"""
+        self.device_manager.drive.ping()
+    
+    @pyqtSlot()
+    def on_drive_status(self):
+        """Đọc status + position của driver"""
+        self.device_manager.drive.read_bulk()
+    
+    @pyqtSlot()
+    def on_drive_position(self):
+        """Đọc position của driver"""
+        self.device_manager.drive.read_position()
+    
+    @pyqtSlot()
+    def on_step_on(self):
+        """Step ON"""
+        self.device_manager.drive.step_on()
+    
+    @pyqtSlot()
+    def on_step_off(self):
+        """Step OFF"""
+        self.device_manager.drive.step_off()
+    
+    @pyqtSlot()
+    def on_move_stop(self):
+        """Dừng motor"""
+        self.device_manager.drive.move_stop()
+    
+    @pyqtSlot()
+    def on_reset_alarm(self):
+        """Reset alarm"""
+        self.device_manager.drive.reset_alarm()
+    
+    @pyqtSlot()
+    def on_jog_ccw(self):
+        """JOG CCW với tốc độ trong spin_jog_speed"""
+        self.device_manager.drive.jog_ccw(self.spin_jog_speed.value())
+    
+    @pyqtSlot()
+    def on_jog_cw(self):
+        """JOG CW với tốc độ trong spin_jog_speed"""
+        self.device_manager.drive.jog_cw(self.spin_jog_speed.value())
+    
+    def _move_params(self, line_edit, spin):
+        """Đọc (giá trị, speed) từ widget một lần trên GUI thread, để lệnh drive
+        chỉ nhận giá trị thuần; ValueError nếu text không phải số nguyên"""
+        return int(line_edit.text()), spin.value()
+    
     def on_move_absolute(self):
         """Handle Move Absolute"""
         try:
-            pos = int(self.le_abs_pos.text())
-            speed = self.spin_abs_speed.value()
-            if self.device_manager:
-                self.device_manager.drive.move_absolute(pos, speed)
+            pos, speed = self._move_params(self.le_abs_pos, self.spin_abs_speed)
         except ValueError:
             QMessageBox.warning(self, "Error", "Invalid position value")
+            return
+        self.device_manager.drive.move_absolute(pos, speed)
     
     def on_move_incremental(self):
         """Handle Move Incremental"""
         try:
-            offset = int(self.le_inc_offset.text())
-            speed = self.spin_inc_speed.value()
-            if self.device_manager:
-                self.device_manager.drive.move_incremental(offset, speed)
+            offset, speed = self._move_params(self.le_inc_offset, self.spin_inc_speed)
         except ValueError:
             QMessageBox.warning(self, "Error", "Invalid offset value")
+            return
+        self.device_manager.drive.move_incremental(offset, speed)
     
     def on_open_event_log(self):
         """Open floating event log window"""
-        if not self.log_window:
-            self.log_window = EventLogWindow()
         self.log_window.show()
         self.log_window.raise_()
         self.log_window.activateWindow()
@@ -544,22 +811,45 @@ class SlaveMonitorGUI(QMainWindow):
                 )
                 mode_str = f"{port} {baudrate} {parity}{stopbits}"
             
-            if self.modbus_manager.open():
-                self.device_manager = DeviceManager(self.modbus_manager)
-                self.lbl_status.setText(f"✅ CONNECTED ({mode_str})")
-                self.lbl_status.setStyleSheet("background-color: #90EE90; padding: 8px; font-size: 11pt; font-weight: bold;")
-                self.btn_open.setEnabled(False)
-                self.btn_close.setEnabled(True)
-                logger.info(f"Connected: {mode_str}", "UI")
-            else:
-                self.lbl_status.setText("❌ CONNECTION FAILED")
-                self.lbl_status.setStyleSheet("background-color: #FFB6C1; padding: 8px; font-size: 11pt; font-weight: bold;")
-                self.modbus_manager = None
-                self.device_manager = None
         except Exception as e:
             QMessageBox.critical(self, "Error", str(e))
             self.modbus_manager = None
             self.device_manager = None
+            return
+        
+        # open() chạy trên thread pool, kết quả về _on_open_finished
+        self.btn_open.setEnabled(False)
+        self.lbl_status.setText(f"⏳ CONNECTING ({mode_str})...")
+        self._open_mode_str = mode_str
+        self._open_task = _OpenConnectionTask(self.modbus_manager)
+        self._open_task.signals.finished.connect(self._on_open_finished, Qt.QueuedConnection)
+        QThreadPool.globalInstance().start(self._open_task)
+    
+    @pyqtSlot(bool, str)
+    def _on_open_finished(self, ok, error):
+        """Cập nhật UI sau khi open() trên thread pool kết thúc"""
+        self._open_task = None
+        mode_str = self._open_mode_str
+        if ok and self.modbus_manager is not None:
+            # Không poll theo timer: DeviceManager báo mỗi khi device/stats đổi
+            self.device_manager = DeviceManager(self.modbus_manager)
+            self.device_manager.set_listener(self.request_refresh)
+            self.request_refresh()
+            self.bind_device_buttons()
+            self.lbl_status.setText(f"✅ CONNECTED ({mode_str})")
+            self.lbl_status.setStyleSheet(STYLE_STATUS_CONN)
+            self.btn_close.setEnabled(True)
+            logger.info(f"Connected: {mode_str}", "UI")
+        else:
+            self.lbl_status.setText("❌ CONNECTION FAILED")
+            self.lbl_status.setStyleSheet(STYLE_STATUS_FAIL)
+            self.btn_open.setEnabled(True)
+            if self.modbus_manager is not None:
+                self.modbus_manager.close()
+            self.modbus_manager = None
+            self.device_manager = None
+            if error:
+                logger.warning(f"Connect {mode_str} failed: {error}", "UI")
     
     def on_close_connection(self):
         """Close connection"""
@@ -567,82 +857,128 @@ class SlaveMonitorGUI(QMainWindow):
             self.modbus_manager.close()
             self.modbus_manager = None
             self.device_manager = None
+            self.bind_device_buttons()
             
             self.lbl_status.setText("❌ DISCONNECTED")
-            self.lbl_status.setStyleSheet("background-color: #ffffcc; padding: 8px; font-size: 11pt; font-weight: bold;")
+            self.lbl_status.setStyleSheet(STYLE_STATUS_CLOSED)
             self.btn_open.setEnabled(True)
             self.btn_close.setEnabled(False)
             logger.info("Disconnected", "UI")
     
-    def refresh_ui(self):
-        """Update UI periodically"""
-        if not self.device_manager:
+    def request_refresh(self):
+        """Yêu cầu refresh_ui từ bất kỳ thread nào; bỏ qua nếu đã có một lần đang chờ"""
+        if self._refresh_pending:
+            return
+        self._refresh_pending = True
+        QMetaObject.invokeMethod(self, "refresh_ui", Qt.QueuedConnection)
+    
+    def post_log_line(self, seq, line):
+        """Callback của logger (thread QueueListener): queue dòng log sang log window"""
+        QMetaObject.invokeMethod(
+            self.log_window, "append_line", Qt.QueuedConnection,
+            Q_ARG(int, seq), Q_ARG(str, line)
+        )
+    
+    def _set_text(self, label, text):
+        """setText chỉ khi text khác lần trước đã set cho label này"""
+        key = id(label)
+        if self._label_cache.get(key) == text:
             return
+        self._label_cache[key] = text
+        label.setText(text)
+    
+    def _repaint_txrx(self):
+        """Vẽ TX/RX từ snapshot mới nhất rồi khóa nhịp TXRX_REFRESH_MS"""
+        if not self.device_manager or self._active_tab != 0:
+            return
+        modbus_st = self.device_manager.get_all_status().modbus
+        if modbus_st is self._last_modbus:
+            return
+        self._last_modbus = modbus_st
+        self._set_text(self.lbl_sensor_tx, modbus_st.get("last_tx", "---"))
+        self._set_text(self.lbl_sensor_rx, modbus_st.get("last_rx", "---"))
+        self._txrx_timer.start()
+    
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.request_refresh()
+    
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QEvent.WindowStateChange and not self.isMinimized():
+            self.request_refresh()
+    
+    @pyqtSlot()
+    def refresh_ui(self):
+        """Vẽ lại UI theo snapshot trạng thái mới nhất - chạy khi device báo thay đổi
+        (request_refresh), khi đổi tab và khi cửa sổ hiện lại, không theo timer"""
+        self._refresh_pending = False
+        if not self.device_manager or not self.isVisible() or self.isMinimized():
+            return  # Cửa sổ ẩn/thu nhỏ: showEvent/changeEvent sẽ refresh lại
         
         status = self.device_manager.get_all_status()
+        tab = self._active_tab
         
         # Update TX/RX display
-        modbus_st = status["modbus"]
-        self.lbl_sensor_tx.setText(modbus_st.get("last_tx", "---"))
-        self.lbl_sensor_rx.setText(modbus_st.get("last_rx", "---"))
+        if tab == 0 and status.modbus is not self._last_modbus:
+            if not self._txrx_timer.isActive():
+                self._repaint_txrx()
         
         # Update Sensor
-        sensor_st = status["sensor"]
-        self.lbl_sensor_status.setText(
-            f"Status: {'✅ Connected' if sensor_st['connected'] else '❌ Disconnected'}"
-        )
-        self.lbl_sensor_status.setStyleSheet(
-            f"font-size: 11pt; font-weight: bold; color: {'green' if sensor_st['connected'] else 'red'};"
-        )
-        
-        self.lbl_sensor_last.setText(f"Last Read: {sensor_st['last_read']}")
-        
-        if "temperature" in sensor_st["data"]:
-            self.lbl_sensor_temp.setText(f"Temp: {sensor_st['data']['temperature']}")
-            self.lbl_sensor_humi.setText(f"Humi: {sensor_st['data']['humidity']}")
-        
-        self.lbl_sensor_counters.setText(
-            f"OK: {sensor_st['ok_count']} | Timeout: {sensor_st['timeout_count']} | Error: {sensor_st['crc_error_count']}"
-        )
+        sensor_st = status.sensor
+        if tab == 1 and sensor_st is not self._last_sensor:
+            self._last_sensor = sensor_st
+            if sensor_st.connected != self._sensor_prev_connected:
+                self._sensor_prev_connected = sensor_st.connected
+                self.lbl_sensor_status.setText(self._CONN_STRS[bool(sensor_st.connected)])
+                self.lbl_sensor_status.setPalette(self._conn_palettes[bool(sensor_st.connected)])
+            
+            self._set_text(self.lbl_sensor_last, f"Last Read: {sensor_st.last_read}")
+            
+            data = sensor_st.data
+            if "temperature" in data:
+                self._set_text(self.lbl_sensor_temp, f"Temp: {data['temperature']}")
+                self._set_text(self.lbl_sensor_humi, f"Humi: {data['humidity']}")
+            
+            sig = (sensor_st.ok, sensor_st.timeout, sensor_st.err)
+            if sig != self._shown_sig.get("sensor_counters"):
+                self._shown_sig["sensor_counters"] = sig
+                self.lbl_sensor_ok.setNum(sig[0])
+                self.lbl_sensor_timeout.setNum(sig[1])
+                self.lbl_sensor_err.setNum(sig[2])
         
         # Update Drive
-        drive_st = status["drive"]
-        self.lbl_drive_status_text.setText(
-            f"Status: {'✅ Connected' if drive_st['connected'] else '❌ Disconnected'}"
-        )
-        self.lbl_drive_status_text.setStyleSheet(
-            f"font-size: 11pt; font-weight: bold; color: {'green' if drive_st['connected'] else 'red'};"
-        )
-        
-        self.lbl_drive_last.setText(f"Last Read: {drive_st['last_read']}")
-        
-        status_parts = [f"{k}: {v}" for k, v in drive_st["data"].items() if k not in ["position"]]
-        status_txt = " | ".join(status_parts) if status_parts else "---"
-        
-        pos_txt = drive_st["data"].get("position", "---")
-        self.lbl_drive_info.setText(f"Status: {status_txt} | Position: {pos_txt}")
-        
-        self.lbl_drive_counters.setText(
-            f"OK: {drive_st['ok_count']} | Timeout: {drive_st['timeout_count']} | Error: {drive_st['crc_error_count']}"
-        )
-        
-        # Update log window if open
-        if self.log_window:
-            log_entries = logger.get_buffer()
-            self.log_window.update_log(log_entries)
+        drive_st = status.drive
+        if tab == 2 and drive_st is not self._last_drive:
+            self._last_drive = drive_st
+            if drive_st.connected != self._drive_prev_connected:
+                self._drive_prev_connected = drive_st.connected
+                self.lbl_drive_status_text.setText(self._CONN_STRS[bool(drive_st.connected)])
+                self.lbl_drive_status_text.setPalette(self._conn_palettes[bool(drive_st.connected)])
+            
+            self._set_text(self.lbl_drive_last, f"Last Read: {drive_st.last_read}")
+            self._set_text(self.lbl_drive_info, drive_st.data_text)
+            
+            sig = (drive_st.ok, drive_st.timeout, drive_st.err)
+            if sig != self._shown_sig.get("drive_counters"):
+                self._shown_sig["drive_counters"] = sig
+                self.lbl_drive_ok.setNum(sig[0])
+                self.lbl_drive_timeout.setNum(sig[1])
+                self.lbl_drive_err.setNum(sig[2])
     
     def closeEvent(self, event):
         """Cleanup before exit"""
+        logger.set_line_callback(None)
         if self.modbus_manager:
             self.modbus_manager.close()
-        if self.log_window:
-            self.log_window.close()
+        self.log_window.close()
         logger.info("Application closed", "UI")
         event.accept()
 
 def main():
     """Application entry point"""
     app = QApplication(sys.argv)
+    app.setStyleSheet(APP_STYLESHEET)
     window = SlaveMonitorGUI()
     window.show()
     sys.exit(app.exec())
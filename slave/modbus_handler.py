@@ -1,11 +1,71 @@
 """
 Modbus Handler - Sử dụng pymodbus cho RS-485 Serial RTU + Modbus TCP
 """
+import functools
+import struct
+import threading
 import time
-from datetime import datetime
+from collections import namedtuple
+from enum import IntEnum
 from pymodbus.client import ModbusSerialClient, ModbusTcpClient
-from pymodbus.exceptions import ModbusException, ConnectionException
+from pymodbus.exceptions import ModbusException, ConnectionException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
 from .logger_handler import logger
+from .config import POLL_MAX_GAP
+
+# Độ lệch wall-clock/monotonic lấy một lần, để đổi timestamp monotonic ra giờ hiển thị
+_WALL_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+
+def format_hms(mono_ns: int) -> str:
+    """Đổi timestamp monotonic_ns sang chuỗi HH:MM:SS (giờ địa phương)"""
+    return time.strftime("%H:%M:%S", time.localtime((mono_ns + _WALL_OFFSET_NS) / 1e9))
+
+
+# Số register tối đa một FC03/FC04 được phép đọc (giới hạn của chuẩn Modbus)
+MAX_READ_REGISTERS = 125
+
+
+class ErrorCode(IntEnum):
+    """Mã lỗi của transaction gần nhất (so sánh số nguyên thay vì chuỗi lỗi)
+
+    pymodbus tự kiểm tra CRC và bỏ frame hỏng, nên lỗi CRC hiện ra dưới dạng TIMEOUT.
+    """
+    OK = 0
+    TIMEOUT = 1          # Không có / mất phản hồi
+    FRAMING = 2          # Phản hồi không hợp lệ hoặc lỗi khác trong lúc giao dịch
+    EXCEPTION = 3        # Slave trả về Modbus exception response
+    NOT_CONNECTED = 4
+
+
+def _error_code_for(err) -> ErrorCode:
+    """Phân loại lỗi của pymodbus (response lỗi hoặc exception) thành ErrorCode"""
+    if isinstance(err, ExceptionResponse):
+        return ErrorCode.EXCEPTION
+    if isinstance(err, ConnectionException):
+        return ErrorCode.NOT_CONNECTED
+    if isinstance(err, ModbusIOException):
+        return ErrorCode.TIMEOUT
+    return ErrorCode.FRAMING
+
+
+def coalesce_blocks(blocks, max_gap: int = POLL_MAX_GAP,
+                    max_count: int = MAX_READ_REGISTERS) -> list:
+    """Gộp các vùng đọc [(slave_id, start, count), ...] của cùng slave khi
+    khoảng trống giữa chúng ≤ max_gap register và vùng gộp không vượt quá
+    max_count register → list vùng đã gộp, sắp theo (slave_id, start).
+    Đọc thừa vài register rẻ hơn một round-trip RS-485."""
+    merged = []
+    for slave_id, start, count in sorted(blocks):
+        if merged:
+            m_slave, m_start, m_count = merged[-1]
+            m_end = m_start + m_count
+            new_count = max(m_end, start + count) - m_start
+            if m_slave == slave_id and start - m_end <= max_gap and new_count <= max_count:
+                merged[-1] = (m_slave, m_start, new_count)
+                continue
+        merged.append((slave_id, start, count))
+    return merged
 
 
 class ModbusClientManager:
@@ -23,7 +83,38 @@ class ModbusClientManager:
         self.last_tx_frame = ""
         self.last_rx_frame = ""
         self.last_error = ""
-        self.last_success_time = None
+        self.last_error_code = ErrorCode.OK
+        self.last_success_ns = None  # time.monotonic_ns() của transaction OK gần nhất
+        
+        # Tăng mỗi transaction → get_stats() chỉ dựng lại dict khi có thay đổi
+        self.stats_version = 0
+        self._stats_cache = None
+        self._stats_cache_version = -1
+        
+        # Cache đọc FC03/FC04: (slave_id, fc, address, count) → (monotonic, registers).
+        # Tắt mặc định (TTL 0); bật chung qua read_cache_ttl hoặc từng lần đọc qua max_age
+        self.read_cache_ttl = 0.0
+        self._rcache = {}
+    
+    def _cache_get(self, key, max_age):
+        """registers còn hạn trong cache hoặc None"""
+        if max_age is None:
+            max_age = self.read_cache_ttl
+        if max_age <= 0:
+            return None
+        entry = self._rcache.get(key)
+        if entry is None or time.monotonic() - entry[0] > max_age:
+            return None
+        return entry[1]
+    
+    def _invalidate_cache(self, slave_id: int, address: int, count: int):
+        """Bỏ các vùng FC03 đã cache của slave giao với [address, address + count)"""
+        if not self._rcache:
+            return
+        end = address + count
+        for key in [k for k in self._rcache
+                    if k[0] == slave_id and k[1] == 0x03 and k[2] < end and address < k[2] + k[3]]:
+            del self._rcache[key]
     
     def open(self) -> bool:
         """Mở kết nối - override trong subclass"""
@@ -34,21 +125,35 @@ class ModbusClientManager:
         if self.client:
             self.client.close()
             self.is_open = False
+        self._rcache.clear()
     
     def _log_transaction(self, request_type: str, success: bool):
         """Log transaction details"""
         self.tx_count += 1
         if success:
             self.rx_count += 1
-            self.last_success_time = datetime.now()
+            self.last_success_ns = time.monotonic_ns()
             self.last_error = ""
+            self.last_error_code = ErrorCode.OK
         else:
             self.timeout_count += 1
     
-    def read_holding_registers(self, slave_id: int, address: int, count: int) -> dict:
-        """FC03: Read Holding Registers"""
+    def read_holding_registers(self, slave_id: int, address: int, count: int,
+                               max_age: float = None) -> dict:
+        """FC03: Read Holding Registers
+
+        max_age > 0 (hoặc read_cache_ttl khi không truyền): trả về kết quả đọc
+        cùng vùng còn trong hạn mà không gửi transaction (registers dùng chung,
+        không được sửa)."""
+        key = (slave_id, 0x03, address, count)
+        registers = self._cache_get(key, max_age)
+        if registers is not None:
+            return {"registers": registers, "count": len(registers)}
+        
+        self.stats_version += 1
         if not self.is_open or not self.client:
             self.last_error = "Not connected"
+            self.last_error_code = ErrorCode.NOT_CONNECTED
             return {"error": self.last_error}
         
         try:
@@ -63,15 +168,17 @@ class ModbusClientManager:
             if result.isError():
                 self.timeout_count += 1
                 self.last_error = f"Modbus Error: {result}"
+                self.last_error_code = _error_code_for(result)
                 self.last_rx_frame = "ERROR"
                 logger.warning(f"FC03 failed: {self.last_error}", "MODBUS")
                 return {"error": self.last_error}
             
             self._log_transaction("FC03", True)
             registers = result.registers
+            self._rcache[key] = (time.monotonic(), registers)
             self.last_rx_frame = f"FC03 OK: {len(registers)} regs"
             
-            logger.debug(f"FC03: Slave {slave_id}, {len(registers)} registers read", "MODBUS")
+            logger.debug("FC03: Slave %d, %d registers read", "MODBUS", slave_id, len(registers))
             
             return {
                 "registers": registers,
@@ -81,14 +188,27 @@ class ModbusClientManager:
         except Exception as e:
             self.error_count += 1
             self.last_error = str(e)
+            self.last_error_code = _error_code_for(e)
             self.last_rx_frame = "EXCEPTION"
             logger.error(f"FC03 exception: {e}", "MODBUS")
             return {"error": str(e)}
     
-    def read_input_registers(self, slave_id: int, address: int, count: int) -> dict:
-        """FC04: Read Input Registers"""
+    def read_input_registers(self, slave_id: int, address: int, count: int,
+                             max_age: float = None) -> dict:
+        """FC04: Read Input Registers
+
+        max_age > 0 (hoặc read_cache_ttl khi không truyền): trả về kết quả đọc
+        cùng vùng còn trong hạn mà không gửi transaction (registers dùng chung,
+        không được sửa)."""
+        key = (slave_id, 0x04, address, count)
+        registers = self._cache_get(key, max_age)
+        if registers is not None:
+            return {"registers": registers, "count": len(registers)}
+        
+        self.stats_version += 1
         if not self.is_open or not self.client:
             self.last_error = "Not connected"
+            self.last_error_code = ErrorCode.NOT_CONNECTED
             return {"error": self.last_error}
         
         try:
@@ -103,15 +223,17 @@ class ModbusClientManager:
             if result.isError():
                 self.timeout_count += 1
                 self.last_error = f"Modbus Error: {result}"
+                self.last_error_code = _error_code_for(result)
                 self.last_rx_frame = "ERROR"
                 logger.warning(f"FC04 failed: {self.last_error}", "MODBUS")
                 return {"error": self.last_error}
             
             self._log_transaction("FC04", True)
             registers = result.registers
+            self._rcache[key] = (time.monotonic(), registers)
             self.last_rx_frame = f"FC04 OK: {len(registers)} regs"
             
-            logger.debug(f"FC04: Slave {slave_id}, {len(registers)} registers read", "MODBUS")
+            logger.debug("FC04: Slave %d, %d registers read", "MODBUS", slave_id, len(registers))
             
             return {
                 "registers": registers,
@@ -121,16 +243,20 @@ class ModbusClientManager:
         except Exception as e:
             self.error_count += 1
             self.last_error = str(e)
+            self.last_error_code = _error_code_for(e)
             self.last_rx_frame = "EXCEPTION"
             logger.error(f"FC04 exception: {e}", "MODBUS")
             return {"error": str(e)}
     
     def write_register(self, slave_id: int, address: int, value: int) -> bool:
         """FC06: Write Single Register"""
+        self.stats_version += 1
         if not self.is_open or not self.client:
             self.last_error = "Not connected"
+            self.last_error_code = ErrorCode.NOT_CONNECTED
             return False
         
+        self._invalidate_cache(slave_id, address, 1)
         try:
             self.last_tx_frame = f"FC06 Slave={slave_id} Addr=0x{address:04X} Val=0x{value:04X}"
             
@@ -143,6 +269,7 @@ class ModbusClientManager:
             if result.isError():
                 self.timeout_count += 1
                 self.last_error = f"Modbus Error: {result}"
+                self.last_error_code = _error_code_for(result)
                 self.last_rx_frame = "ERROR"
                 logger.warning(f"FC06 failed: {self.last_error}", "MODBUS")
                 return False
@@ -150,22 +277,26 @@ class ModbusClientManager:
             self._log_transaction("FC06", True)
             self.last_rx_frame = f"FC06 OK"
             
-            logger.debug(f"FC06: Slave {slave_id}, wrote 0x{value:04X} to 0x{address:04X}", "MODBUS")
+            logger.debug("FC06: Slave %d, wrote 0x%04X to 0x%04X", "MODBUS", slave_id, value, address)
             return True
             
         except Exception as e:
             self.error_count += 1
             self.last_error = str(e)
+            self.last_error_code = _error_code_for(e)
             self.last_rx_frame = "EXCEPTION"
             logger.error(f"FC06 exception: {e}", "MODBUS")
             return False
     
     def write_registers(self, slave_id: int, address: int, values: list) -> bool:
         """FC16: Write Multiple Registers"""
+        self.stats_version += 1
         if not self.is_open or not self.client:
             self.last_error = "Not connected"
+            self.last_error_code = ErrorCode.NOT_CONNECTED
             return False
         
+        self._invalidate_cache(slave_id, address, len(values))
         try:
             self.last_tx_frame = f"FC16 Slave={slave_id} Addr=0x{address:04X} Count={len(values)}"
             
@@ -178,6 +309,7 @@ class ModbusClientManager:
             if result.isError():
                 self.timeout_count += 1
                 self.last_error = f"Modbus Error: {result}"
+                self.last_error_code = _error_code_for(result)
                 self.last_rx_frame = "ERROR"
                 logger.warning(f"FC16 failed: {self.last_error}", "MODBUS")
                 return False
@@ -185,24 +317,47 @@ class ModbusClientManager:
             self._log_transaction("FC16", True)
             self.last_rx_frame = f"FC16 OK: {len(values)} regs"
             
-            logger.debug(f"FC16: Slave {slave_id}, wrote {len(values)} registers", "MODBUS")
+            logger.debug("FC16: Slave %d, wrote %d registers", "MODBUS", slave_id, len(values))
             return True
             
         except Exception as e:
             self.error_count += 1
             self.last_error = str(e)
+            self.last_error_code = _error_code_for(e)
             self.last_rx_frame = "EXCEPTION"
             logger.error(f"FC16 exception: {e}", "MODBUS")
             return False
     
+    def read_many(self, slave_id: int, addresses, max_gap: int = 4) -> dict:
+        """FC03 cho nhiều holding register rời rạc của một slave: gộp địa chỉ
+        thành các vùng liên tiếp (coalesce_blocks), mỗi vùng một transaction
+        → {address: value}. Địa chỉ thuộc vùng đọc lỗi không có trong kết quả
+        (xem last_error)."""
+        wanted = sorted(set(addresses))
+        values = {}
+        for _, start, count in coalesce_blocks(
+            [(slave_id, address, 1) for address in wanted], max_gap
+        ):
+            registers = self.read_holding_registers(slave_id, start, count).get("registers")
+            if registers is None:
+                continue
+            end = start + len(registers)
+            for address in wanted:
+                if start <= address < end:
+                    values[address] = registers[address - start]
+        return values
+    
     def ping(self, slave_id: int) -> bool:
         """Ping một slave bằng cách đọc 1 register"""
-        result = self.read_holding_registers(slave_id, 0x0000, 1)
+        result = self.read_holding_registers(slave_id, 0x0000, 1, max_age=0)
         return "error" not in result
     
     def get_stats(self) -> dict:
-        """Trả về thống kê"""
-        return {
+        """Trả về thống kê (dict được cache, không được sửa)"""
+        if self._stats_cache_version == self.stats_version:
+            return self._stats_cache
+        self._stats_cache_version = self.stats_version
+        self._stats_cache = {
             "tx_count": self.tx_count,
             "rx_count": self.rx_count,
             "timeout_count": self.timeout_count,
@@ -210,12 +365,23 @@ class ModbusClientManager:
             "last_tx": self.last_tx_frame or "---",
             "last_rx": self.last_rx_frame or "---",
             "last_error": self.last_error,
-            "last_success": self.last_success_time.strftime("%H:%M:%S") if self.last_success_time else "Never"
+            "last_success": format_hms(self.last_success_ns) if self.last_success_ns else "Never"
         }
+        return self._stats_cache
+
+
+# Một ModbusSerialClient cho mỗi cổng trong process, dùng chung giữa các
+# RS485Manager cùng cấu hình: key cấu hình cổng → [client, số manager đang dùng]
+_CLIENT_POOL = {}
+_CLIENT_POOL_LOCK = threading.Lock()
 
 
 class RS485Manager(ModbusClientManager):
-    """Quản lý kết nối RS-485/Serial RTU với pymodbus"""
+    """Quản lý kết nối RS-485/Serial RTU với pymodbus
+
+    Client lấy từ _CLIENT_POOL: mở lại cùng cổng/cấu hình không mở lại COM,
+    cổng chỉ thực sự đóng khi manager cuối cùng close().
+    """
     
     def __init__(self, port: str, baudrate: int, parity: str = "N", 
                  stopbits: int = 1, databits: int = 8, timeout: float = 1.0):
@@ -226,20 +392,51 @@ class RS485Manager(ModbusClientManager):
         self.stopbits = stopbits
         self.databits = databits
         self.timeout = timeout
+        self._pool_key = None  # Key trong _CLIENT_POOL khi đang giữ client
+    
+    def _acquire_client(self) -> bool:
+        """Lấy client dùng chung (tạo + connect nếu chưa có) và tăng refcount"""
+        key = (self.port, self.baudrate, self.parity, self.stopbits, self.databits, self.timeout)
+        with _CLIENT_POOL_LOCK:
+            entry = _CLIENT_POOL.get(key)
+            if entry is None:
+                client = ModbusSerialClient(
+                    port=self.port,
+                    baudrate=self.baudrate,
+                    parity=self.parity,
+                    stopbits=self.stopbits,
+                    bytesize=self.databits,
+                    timeout=self.timeout
+                )
+                if not client.connect():
+                    client.close()  # Nhả handle cổng nếu connect mở dở
+                    return False
+                entry = _CLIENT_POOL[key] = [client, 0]
+            entry[1] += 1
+            self.client = entry[0]
+            self._pool_key = key
+            return True
+    
+    def _release_client(self):
+        """Giảm refcount; đóng cổng khi không còn manager nào dùng"""
+        key, self._pool_key = self._pool_key, None
+        if key is None:
+            return
+        with _CLIENT_POOL_LOCK:
+            entry = _CLIENT_POOL.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del _CLIENT_POOL[key]
+                entry[0].close()
     
     def open(self) -> bool:
-        """Mở cổng serial"""
+        """Mở cổng serial (hoặc dùng lại client đã mở của cùng cổng)"""
+        if self._pool_key is not None:
+            return self.is_open
         try:
-            self.client = ModbusSerialClient(
-                port=self.port,
-                baudrate=self.baudrate,
-                parity=self.parity,
-                stopbits=self.stopbits,
-                bytesize=self.databits,
-                timeout=self.timeout
-            )
-            
-            connected = self.client.connect()
+            connected = self._acquire_client()
             
             if connected:
                 self.is_open = True
@@ -261,9 +458,11 @@ class RS485Manager(ModbusClientManager):
             return False
     
     def close(self):
-        """Đóng cổng serial"""
-        super().close()
-        if self.client:
+        """Trả client về pool (cổng đóng khi manager cuối cùng close)"""
+        self.is_open = False
+        self._rcache.clear()
+        if self._pool_key is not None:
+            self._release_client()
             logger.info(f"Closed {self.port}", "RS485")
 
 
@@ -310,30 +509,55 @@ class ModbusTCPManager(ModbusClientManager):
             logger.info(f"Closed connection to {self.host}:{self.port}", "MODBUS_TCP")
 
 
+# Ghép/tách 32-bit ↔ 2 thanh ghi Big Endian: đọc position qua _S32 (struct trả về
+# số có dấu); khi ghi, mask 0xFFFFFFFF đã cho đúng dạng bù hai của số âm nên
+# pack có dấu và không dấu dùng chung _U32 (giá trị ngoài 32-bit bị cắt bớt)
+_U32 = struct.Struct(">I")
+_S32 = struct.Struct(">i")
+_REGS2 = struct.Struct(">HH")
+
+
+@functools.lru_cache(maxsize=32)
+def _regs_structs(count: int) -> tuple:
+    """(Struct unsigned, Struct signed) cho `count` thanh ghi 16-bit"""
+    return struct.Struct(">%dH" % count), struct.Struct(">%dh" % count)
+
+
+class SHT20Reading(namedtuple("SHT20Reading", "temperature_c humidity_percent raw_temp raw_humi")):
+    """Kết quả parse_sht20_response (truy cập theo thuộc tính, vd: r.temperature_c)"""
+    __slots__ = ()
+    
+    def to_dict(self) -> dict:
+        """dict cho chỗ cần JSON/export"""
+        return dict(zip(self._fields, self))
+
+
 class DataParser:
     """Parse Modbus responses thành dữ liệu hữu ích"""
     
     @staticmethod
-    def parse_sht20_response(registers: list) -> dict:
-        """Parse SHT20 sensor response (2 registers)"""
+    def parse_sht20_response(registers: list):
+        """Parse SHT20 sensor response (2 registers) → SHT20Reading, None nếu thiếu register"""
         if len(registers) < 2:
-            return {"error": "Insufficient registers"}
+            return None
         
-        temp_raw = registers[0]
-        humi_raw = registers[1]
+        # Đổi sang số có dấu 16-bit không rẽ nhánh: (x ^ 0x8000) - 0x8000
+        temp_raw = (registers[0] ^ 0x8000) - 0x8000
+        humi_raw = (registers[1] ^ 0x8000) - 0x8000
         
-        # Convert to signed if needed
-        if temp_raw & 0x8000:
-            temp_raw = temp_raw - (1 << 16)
-        if humi_raw & 0x8000:
-            humi_raw = humi_raw - (1 << 16)
-        
-        return {
-            "temperature_c": temp_raw / 10.0,
-            "humidity_percent": humi_raw / 10.0,
-            "raw_temp": temp_raw,
-            "raw_humi": humi_raw
-        }
+        return SHT20Reading(temp_raw / 10.0, humi_raw / 10.0, temp_raw, humi_raw)
+    
+    @staticmethod
+    def parse_sht20_batch(registers: list) -> list:
+        """Parse nhiều cặp (temp, humi) liên tiếp, vd một FC04 đọc gộp nhiều
+        sensor → [(temperature_c, humidity_percent), ...]. Đổi dấu cả khối
+        bằng một lần pack/unpack thay vì xét từng thanh ghi."""
+        count = len(registers) & ~1
+        if not count:
+            return []
+        unsigned, signed = _regs_structs(count)
+        raw = signed.unpack(unsigned.pack(*registers[:count]))
+        return [(raw[i] / 10.0, raw[i + 1] / 10.0) for i in range(0, count, 2)]
     
     @staticmethod
     def parse_position_registers(registers: list) -> int:
@@ -341,29 +565,15 @@ class DataParser:
         if len(registers) < 2:
             return 0
         
-        hi = registers[0]
-        lo = registers[1]
-        pos = (hi << 16) | lo
-        
-        # Convert to signed
-        if pos & 0x80000000:
-            pos = pos - (1 << 32)
-        
-        return pos
+        return _S32.unpack(_REGS2.pack(registers[0] & 0xFFFF, registers[1] & 0xFFFF))[0]
     
     @staticmethod
     def pack_s32_to_regs(val: int) -> list:
-        """Pack 32-bit signed thành 2 registers"""
-        if val < 0:
-            val = (1 << 32) + val
-        hi = (val >> 16) & 0xFFFF
-        lo = val & 0xFFFF
-        return [hi, lo]
+        """Pack 32-bit signed thành 2 registers (cùng cách mask với pack_u32_to_regs)"""
+        return DataParser.pack_u32_to_regs(val)
     
     @staticmethod
     def pack_u32_to_regs(val: int) -> list:
         """Pack 32-bit unsigned thành 2 registers"""
-        hi = (val >> 16) & 0xFFFF
-        lo = val & 0xFFFF
-        return [hi, lo]
+        return list(_REGS2.unpack(_U32.pack(val & 0xFFFFFFFF)))
 
@@ -25,7 +25,7 @@ Chương trình này chia làm 3 chức năng chính:
 ================================================================================
 """
 
-import sys, time, struct
+import sys, time, struct, functools
 import serial
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QPushButton, QVBoxLayout, QLabel, QHBoxLayout,
@@ -43,13 +43,36 @@ SLAVE_ID = 2
 SLAVE_ID_SHT20 = 1
 SERIAL_TIMEOUT = 1.0
 READ_INTERVAL_MS = 500
+AUTO_READ_MAX_INTERVAL_MS = 2000  # Auto-read giãn tối đa tới đây khi driver đứng yên
+BATCH_DRIVE_READS = True    # False nếu driver từ chối đọc span 0x1000..0x1010
 #
 
+# Bit trong status word EZi-STEP (reg 0x1010), cùng mask với DriveDevice.read_status
+STATUS_MASK_ALARM = 0x8000
+STATUS_MASK_INPOS = 0x0010
+STATUS_MASK_RUNNING = 0x0004
+
 # ============================================================================
 # PHẦN 1: UTILITY FUNCTIONS (HÀM TIỆN ÍCH)
 # ============================================================================
 # Các hàm hỗ trợ tính toán CRC, đóng gói/giải mã dữ liệu Modbus
 
+def _make_crc16_table() -> tuple:
+    """[UTILITY] Tính sẵn CRC16 (đa thức 0xA001) cho 256 giá trị byte."""
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+# Bảng tính một lần khi import: mỗi byte chỉ còn 1 lần tra bảng thay cho vòng lặp 8 bit
+_CRC16_TABLE = _make_crc16_table()
+
 def crc16_modbus(data: bytes) -> int:
     """
     [UTILITY] Tính toán Modbus CRC16 cho dữ liệu gói tin thô.
@@ -58,26 +81,45 @@ def crc16_modbus(data: bytes) -> int:
     tính toàn vẹn dữ liệu khi truyền qua serial.
     
     Args:
-        data: Mảng byte cần tính CRC
+        data: Mảng byte cần tính CRC (bytes, bytearray hoặc memoryview)
     
     Returns:
         Giá trị CRC16 dạng số nguyên 16-bit
     """
     crc = 0xFFFF
+    table = _CRC16_TABLE
     for b in data:
-        crc ^= b
-        for _ in range(8):
-            if crc & 1:
-                crc = (crc >> 1) ^ 0xA001
-            else:
-                crc >>= 1
-    return crc & 0xFFFF
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+def verify_crc(resp: bytes) -> bool:
+    """[UTILITY] Frame phản hồi đủ dài và CRC16 ở 2 byte cuối khớp với phần dữ liệu.
+    
+    CRC16 Modbus tính trên cả frame (kể cả 2 byte CRC little-endian) bằng 0 khi
+    frame đúng, nên không cần cắt bản sao resp[:-2].
+    """
+    return len(resp) >= 5 and crc16_modbus(resp) == 0
+
+@functools.lru_cache(maxsize=128)
+def hex_upper(data: bytes) -> str:
+    """[UTILITY] Chuỗi HEX in hoa của frame để hiển thị TX/RX.
+    
+    Frame TX là các bytes dựng sẵn và RX lúc driver đứng yên lặp lại y hệt,
+    nên cache theo nội dung: mỗi frame chỉ hex()/upper() một lần.
+    """
+    return data.hex().upper()
+
+# Header 6 byte (slave, FC, địa chỉ, số lượng/giá trị) và CRC (little-endian)
+# đóng gói bằng struct thay cho tách byte thủ công
+_PACK_HDR = struct.Struct(">BBHH").pack
+_PACK_CRC = struct.Struct("<H").pack
 
 # ============================================================================
 # PHẦN 2: SHT20 SENSOR FUNCTIONS (HÀM CẢMBIẾN SHT20)
 # ============================================================================
 # Các hàm liên quan đến việc giao tiếp với cảm biến nhiệt độ/độ ẩm SHT20
 
+@functools.lru_cache(maxsize=8)
 def build_read_sht20(slave_id: int) -> bytes:
     """
     [SHT20] Tạo gói tin Modbus FC04 để đọc dữ liệu từ cảm biến SHT20.
@@ -89,18 +131,10 @@ def build_read_sht20(slave_id: int) -> bytes:
         slave_id: ID của slave SHT20 trên bus Modbus
     
     Returns:
-        Gói tin Modbus hoàn chỉnh kèm CRC
+        Gói tin Modbus hoàn chỉnh kèm CRC (cache theo slave_id, bytes bất biến)
     """
-    func = 0x04
-    reg = 0x0001
-    count = 0x0002
-    data = bytes([
-        slave_id, func,
-        (reg >> 8) & 0xFF, reg & 0xFF,
-        (count >> 8) & 0xFF, count & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x04, 0x0001, 0x0002)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 # ============================================================================
 # PHẦN 3: DRIVE CONTROL FUNCTIONS (HÀM ĐIỀU KHIỂN DRIVER)
@@ -108,6 +142,7 @@ def build_read_sht20(slave_id: int) -> bytes:
 # Các hàm xây dựng gói tin Modbus để điều khiển động cơ bước EZi-STEP
 
 # Build Modbus FC03 Read Holding Registers
+@functools.lru_cache(maxsize=64)
 def build_fc03(slave_id: int, start_reg: int, count: int) -> bytes:
     """
     [DRIVE] Tạo gói tin Modbus FC03 để đọc thanh ghi từ driver EZi-STEP.
@@ -121,18 +156,10 @@ def build_fc03(slave_id: int, start_reg: int, count: int) -> bytes:
         count: Số lượng thanh ghi cần đọc
     
     Returns:
-        Gói tin Modbus FC03 hoàn chỉnh kèm CRC
+        Gói tin Modbus FC03 hoàn chỉnh kèm CRC (cache theo tham số, bytes bất biến)
     """
-    data = bytes([
-        slave_id,
-        0x03,
-        (start_reg >> 8) & 0xFF,
-        start_reg & 0xFF,
-        (count >> 8) & 0xFF,
-        count & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x03, start_reg, count)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 def build_fc06(slave_id: int, reg_addr: int, reg_val: int) -> bytes:
     """
@@ -149,16 +176,8 @@ def build_fc06(slave_id: int, reg_addr: int, reg_val: int) -> bytes:
     Returns:
         Gói tin Modbus FC06 hoàn chỉnh kèm CRC
     """
-    data = bytes([
-        slave_id,
-        0x06,
-        (reg_addr >> 8) & 0xFF,
-        reg_addr & 0xFF,
-        (reg_val >> 8) & 0xFF,
-        reg_val & 0xFF
-    ])
-    crc = crc16_modbus(data)
-    return data + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    data = _PACK_HDR(slave_id, 0x06, reg_addr, reg_val & 0xFFFF)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 def build_fc16(slave_id: int, start_reg: int, registers: list) -> bytes:
     """
@@ -175,30 +194,48 @@ def build_fc16(slave_id: int, start_reg: int, registers: list) -> bytes:
     Returns:
         Gói tin Modbus FC16 hoàn chỉnh kèm CRC
     """
-    reg_count = len(registers)
-    byte_count = reg_count * 2
-    
-    data = bytearray([
-        slave_id,
-        0x10,
-        (start_reg >> 8) & 0xFF,
-        start_reg & 0xFF,
-        (reg_count >> 8) & 0xFF,
-        reg_count & 0xFF,
-        byte_count
-    ])
-    
-    for reg in registers:
-        data.append((reg >> 8) & 0xFF)
-        data.append(reg & 0xFF)
-    
-    crc = crc16_modbus(bytes(data))
-    return bytes(data) + bytes([crc & 0xFF, (crc >> 8) & 0xFF])
+    return finalize_fc16(build_fc16_prefix(slave_id, start_reg, len(registers)), registers)
+
+def build_fc16_prefix(slave_id: int, start_reg: int, reg_count: int) -> bytes:
+    """
+    [DRIVE] Tạo phần header cố định của gói tin FC16.
+    
+    Header (slave, FC, địa chỉ, số thanh ghi, số byte) chỉ phụ thuộc vào lệnh,
+    nên được tạo một lần và dùng lại cho mọi lần gửi với payload khác nhau.
+    
+    Args:
+        slave_id: ID của slave driver
+        start_reg: Địa chỉ thanh ghi bắt đầu ghi
+        reg_count: Số lượng thanh ghi sẽ ghi
+    
+    Returns:
+        7 byte header FC16 (chưa có dữ liệu và CRC)
+    """
+    return struct.pack(">BBHHB", slave_id, 0x10, start_reg, reg_count, reg_count * 2)
+
+def finalize_fc16(prefix: bytes, registers: list) -> bytes:
+    """
+    [DRIVE] Ghép header FC16 dựng sẵn với dữ liệu thanh ghi và CRC.
+    
+    Args:
+        prefix: Header tạo bởi build_fc16_prefix()
+        registers: Danh sách giá trị 16-bit (đúng số lượng khai báo trong header)
+    
+    Returns:
+        Gói tin Modbus FC16 hoàn chỉnh kèm CRC
+    """
+    data = prefix + _regs_struct(len(registers)).pack(*registers)
+    return data + _PACK_CRC(crc16_modbus(data))
 
 # ============================================================================
 # PHẦN 4: DATA PACKING/UNPACKING UTILITIES
 # ============================================================================
 # Các hàm chuyển đổi dữ liệu 32-bit sang/từ định dạng thanh ghi Modbus 16-bit
+# (packer C-coded của struct; đọc có dấu qua _S32, ghi mask 0xFFFFFFFF cho dạng bù hai)
+
+_U32 = struct.Struct(">I")
+_S32 = struct.Struct(">i")
+_REGS2 = struct.Struct(">HH")
 
 def pack_u32_to_regs(val: int) -> list:
     """
@@ -212,25 +249,58 @@ def pack_u32_to_regs(val: int) -> list:
     Returns:
         Danh sách [thanh ghi cao, thanh ghi thấp]
     """
-    hi = (val >> 16) & 0xFFFF
-    lo = val & 0xFFFF
-    return [hi, lo]
+    return list(_REGS2.unpack(_U32.pack(val & 0xFFFFFFFF)))
 
 def pack_s32_to_regs(val: int) -> list:
     """[UTILITY] Split signed 32-bit value into two registers preserving sign."""
-    if val < 0:
-        val = (1 << 32) + val
-    hi = (val >> 16) & 0xFFFF
-    lo = val & 0xFFFF
-    return [hi, lo]
+    return pack_u32_to_regs(val)
 
 def unpack_s32_from_bytes(b: bytes, offset: int) -> int:
     """[UTILITY] Unpack signed 32-bit integer from Modbus payload (Big Endian)."""
-    val = (b[offset] << 24) | (b[offset+1] << 16) | (b[offset+2] << 8) | b[offset+3]
-    # Convert to signed
-    if val & 0x80000000:
-        val = val - (1 << 32)
-    return val
+    return _S32.unpack_from(b, offset)[0]
+
+@functools.lru_cache(maxsize=None)
+def _regs_struct(count: int) -> struct.Struct:
+    return struct.Struct(">%dH" % count)
+
+def unpack_regs(resp: bytes, count: int) -> tuple:
+    """[UTILITY] Unpack `count` 16-bit registers from an FC03/FC04 payload (after the 3-byte header)."""
+    return _regs_struct(count).unpack_from(resp, 3)
+
+def t35_seconds(baudrate: int) -> float:
+    """
+    [UTILITY] Khoảng lặng 3.5 ký tự giữa hai frame Modbus RTU (giây).
+    
+    Mỗi ký tự RTU là 11 bit (start + 8 data + parity/stop + stop); trên 19200 baud
+    chuẩn Modbus cố định 1.75 ms.
+    """
+    return max(0.00175, 3.5 * 11 / baudrate)
+
+def read_rtu_response(ser) -> bytes:
+    """
+    [UTILITY] Đọc đúng một frame phản hồi Modbus RTU, độ dài suy ra từ header.
+    
+    Header [slave, FC, byte_count/mã lỗi]: FC03/FC04 còn byte_count + 2 byte CRC,
+    exception (FC | 0x80) còn 2 byte CRC, echo FC06/FC16 đủ 8 byte. Mỗi ser.read(n)
+    chặn tới khi đủ n byte hoặc hết timeout của cổng - không cần vòng lặp poll.
+    
+    Args:
+        ser: Cổng serial đã mở (pyserial)
+    
+    Returns:
+        Frame nhận được (ngắn hơn mong đợi nếu timeout)
+    """
+    header = ser.read(3)
+    if len(header) < 3:
+        return header
+    fc = header[1]
+    if fc & 0x80:
+        remaining = 2
+    elif fc in (0x03, 0x04):
+        remaining = header[2] + 2
+    else:
+        remaining = 5
+    return header + ser.read(remaining)
 
 class SerialWorker(QThread):
     """[UTILITY] Background thread managing raw serial IO for both Driver and SHT20."""
@@ -242,8 +312,12 @@ class SerialWorker(QThread):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        self.t35 = t35_seconds(baudrate)
         self.ser = None
         self.running = False
+        # Chỉ xả buffer cổng khi vừa mở hoặc frame trước lỗi (timeout/CRC),
+        # không xả ở mọi transaction
+        self._needs_resync = True
         
     def run(self):
         try:
@@ -264,31 +338,22 @@ class SerialWorker(QThread):
             return b""
         
         try:
-            self.ser.reset_input_buffer()
-            self.ser.reset_output_buffer()
-            time.sleep(0.01)
+            if self._needs_resync:
+                self.ser.reset_input_buffer()
+                self.ser.reset_output_buffer()
+            time.sleep(self.t35)  # Khoảng lặng giữa hai frame; read chặn chờ slave trả lời
             
             self.ser.write(frame)
             self.ser.flush()
-            time.sleep(0.2)  # Tăng delay để đợi ESP32 xử lý
             
-            resp = b""
-            start_time = time.time()
-            while time.time() - start_time < self.timeout:
-                chunk = self.ser.read(256)
-                if chunk:
-                    resp += chunk
-                    # Nếu đã có dữ liệu, đợi thêm một chút để nhận hết
-                    time.sleep(0.05)
-                else:
-                    if resp:  # Đã có data rồi thì thoát
-                        break
-                    time.sleep(0.01)
+            resp = read_rtu_response(self.ser)
+            self._needs_resync = not verify_crc(resp)
             
-            self.response_received.emit(resp, frame.hex().upper())
+            self.response_received.emit(resp, hex_upper(frame))
             return resp
             
         except Exception as e:
+            self._needs_resync = True
             self.error_occurred.emit(f"Serial error: {e}")
             return b""
     
@@ -299,6 +364,17 @@ class SerialWorker(QThread):
 
 class DriverGUI(QWidget):
     """[GUI] Main window orchestrating Driver controls, status views, and SHT20 widgets."""
+    # Stylesheet dựng sẵn, chọn bằng index bool(cờ) thay vì f-string mỗi lần đọc
+    _POS_STYLES = ("font-size: 14pt; font-weight: bold; color: red;",
+                   "font-size: 14pt; font-weight: bold; color: green;")
+    _ALARM_STYLES = ("font-size: 12pt; font-weight: bold; color: green;",
+                     "font-size: 12pt; font-weight: bold; color: red;")
+    _INPOS_STYLES = ("font-size: 12pt; font-weight: bold; color: orange;",
+                     "font-size: 12pt; font-weight: bold; color: green;")
+    _RUNNING_STYLES = ("font-size: 12pt; font-weight: bold; color: gray;",
+                       "font-size: 12pt; font-weight: bold; color: blue;")
+    _YES_NO = ("NO", "YES")
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("MÁY CHỦ GIÁM SÁT")
@@ -308,6 +384,25 @@ class DriverGUI(QWidget):
         self.read_count = 0
         self.error_count = 0
         
+        # Trạng thái đang hiển thị, để chỉ setStyleSheet khi đổi
+        self._pos_ok = None
+        self._shown_flags = None
+        
+        # Frame đọc định kỳ và frame lệnh cố định dựng sẵn một lần;
+        # lệnh FC16 chỉ giữ sẵn header
+        self._frame_position = build_fc03(SLAVE_ID, 0x1000, 2)
+        self._frame_status = build_fc03(SLAVE_ID, 0x1010, 1)
+        # Auto-read: một FC03 0x1000..0x1010 (17 reg) - vị trí ở reg 0-1, status ở reg 16
+        self._frame_drive_bulk = build_fc03(SLAVE_ID, 0x1000, 0x11)
+        self._frame_sht20 = build_read_sht20(SLAVE_ID_SHT20)
+        self._frame_step_on = build_fc06(SLAVE_ID, 0x0000, 1)
+        self._frame_step_off = build_fc06(SLAVE_ID, 0x0000, 0)
+        self._frame_reset_alarm = build_fc06(SLAVE_ID, 0x0001, 1)
+        self._frame_move_stop = build_fc06(SLAVE_ID, 0x0002, 1)
+        self._prefix_velocity = build_fc16_prefix(SLAVE_ID, 0x30, 4)
+        self._prefix_abs = build_fc16_prefix(SLAVE_ID, 0x10, 4)
+        self._prefix_inc = build_fc16_prefix(SLAVE_ID, 0x20, 4)
+        
         layout = QVBoxLayout()
         
         # Status
@@ -508,8 +603,12 @@ class DriverGUI(QWidget):
         self.timer_sht20 = QTimer()
         self.timer_sht20.timeout.connect(self.read_sht20)
         
+        # Single-shot: lần đọc kế tiếp chỉ được hẹn sau khi lần hiện tại xong
         self.timer_auto_read = QTimer()
+        self.timer_auto_read.setSingleShot(True)
         self.timer_auto_read.timeout.connect(self.auto_read_status)
+        self._auto_reading = False
+        self._auto_interval = READ_INTERVAL_MS
 
         self.setLayout(layout)
         self.init_serial()
@@ -538,7 +637,7 @@ class DriverGUI(QWidget):
 
     def on_response(self, resp, tx_hex):
         """[GUI] Display latest TX/RX frames for troubleshooting."""
-        rx_hex = resp.hex().upper() if resp else '(timeout)'
+        rx_hex = hex_upper(resp) if resp else '(timeout)'
         self.resp_label.setText(f"TX: {tx_hex}\nRX: {rx_hex}")
 
     def on_error(self, error_msg):
@@ -552,101 +651,155 @@ class DriverGUI(QWidget):
             return self.worker.send_frame(frame)
         return b""
 
+    def _validate_echo(self, resp: bytes, expected_fc: int) -> bool:
+        """[UTILITY] Kiểm tra echo FC06/FC16: đúng slave, đúng FC (không có bit
+        exception 0x80), đủ 8 byte và CRC hợp lệ - byte nhiễu không tính là OK."""
+        if not resp or len(resp) < 8:
+            return False
+        if resp[0] != SLAVE_ID or resp[1] != expected_fc:
+            return False
+        return verify_crc(resp)
+
     # ===== Read Functions =====
     def read_position(self):
         """[DRIVE] Đọc vị trí hiện tại từ driver."""
-        frame = build_fc03(SLAVE_ID, 0x1000, 2)  # Reg 0x1000, 2 registers (32-bit)
-        resp = self.send_and_read(frame)
-        
-        if len(resp) >= 9 and resp[1] == 0x03:
+        resp = self.send_and_read(self._frame_position)  # Reg 0x1000, 2 registers (32-bit)
+        self._show_position(resp, len(resp) >= 9 and resp[1] == 0x03)
+
+    def _show_position(self, resp: bytes, valid: bool):
+        """[DRIVE] Hiển thị vị trí 32-bit ở đầu payload FC03 (reg 0-1 của vùng đọc)."""
+        if valid:
             try:
                 position = unpack_s32_from_bytes(resp, 3)
                 self.lbl_position.setText(f"Position: {position:,} pulse")
-                self.lbl_position.setStyleSheet("font-size: 14pt; font-weight: bold; color: green;")
+                self._set_pos_style(True)
             except Exception as e:
                 self.lbl_position.setText(f"Position: ERROR ({e})")
-                self.lbl_position.setStyleSheet("font-size: 14pt; font-weight: bold; color: red;")
+                self._set_pos_style(False)
         else:
             self.lbl_position.setText("Position: NO RESPONSE")
-            self.lbl_position.setStyleSheet("font-size: 14pt; font-weight: bold; color: red;")
+            self._set_pos_style(False)
 
     def read_status(self):
         """[DRIVE] Đọc trạng thái EZi-STEP và cập nhật nhãn cảnh báo."""
-        frame = build_fc03(SLAVE_ID, 0x1010, 1)  # Reg 0x1010, 1 register
-        resp = self.send_and_read(frame)
-        
-        if len(resp) >= 7 and resp[1] == 0x03:
+        resp = self.send_and_read(self._frame_status)  # Reg 0x1010, 1 register
+        self._show_status(resp, len(resp) >= 7 and resp[1] == 0x03, 0)
+
+    def _show_status(self, resp: bytes, valid: bool, reg_index: int):
+        """[DRIVE] Hiển thị status word nằm ở thanh ghi thứ reg_index của payload FC03."""
+        if valid:
             try:
-                status_word = (resp[3] << 8) | resp[4]
-                alarm = (status_word >> 8) & 0xFF
-                inpos = (status_word >> 4) & 0x0F
-                running = (status_word >> 2) & 0x03
-                
-                self.lbl_alarm.setText(f"Alarm: {'YES' if alarm else 'NO'}")
-                self.lbl_alarm.setStyleSheet(
-                    f"font-size: 12pt; font-weight: bold; color: {'red' if alarm else 'green'};"
-                )
-                
-                self.lbl_inpos.setText(f"InPosition: {'YES' if inpos else 'NO'}")
-                self.lbl_inpos.setStyleSheet(
-                    f"font-size: 12pt; font-weight: bold; color: {'green' if inpos else 'orange'};"
-                )
+                status_word = unpack_regs(resp, reg_index + 1)[reg_index]
+                alarm = bool(status_word & STATUS_MASK_ALARM)
+                inpos = bool(status_word & STATUS_MASK_INPOS)
+                running = bool(status_word & STATUS_MASK_RUNNING)
                 
-                self.lbl_running.setText(f"Running: {'YES' if running else 'NO'}")
-                self.lbl_running.setStyleSheet(
-                    f"font-size: 12pt; font-weight: bold; color: {'blue' if running else 'gray'};"
-                )
+                flags = (alarm, inpos, running)
+                if flags != self._shown_flags:
+                    self._shown_flags = flags
+                    yn = self._YES_NO
+                    self.lbl_alarm.setText(f"Alarm: {yn[alarm]}")
+                    self.lbl_alarm.setStyleSheet(self._ALARM_STYLES[alarm])
+                    
+                    self.lbl_inpos.setText(f"InPosition: {yn[inpos]}")
+                    self.lbl_inpos.setStyleSheet(self._INPOS_STYLES[inpos])
+                    
+                    self.lbl_running.setText(f"Running: {yn[running]}")
+                    self.lbl_running.setStyleSheet(self._RUNNING_STYLES[running])
             except Exception as e:
+                self._shown_flags = None
                 self.lbl_alarm.setText(f"Alarm: ERROR")
                 self.lbl_inpos.setText(f"InPosition: ERROR")
                 self.lbl_running.setText(f"Running: ERROR")
         else:
+            self._shown_flags = None
             self.lbl_alarm.setText("Alarm: NO DATA")
             self.lbl_inpos.setText("InPosition: NO DATA")
             self.lbl_running.setText("Running: NO DATA")
 
+    def _set_pos_style(self, ok: bool):
+        """[DRIVE] Đổi màu nhãn position chỉ khi trạng thái OK/lỗi thay đổi."""
+        if ok != self._pos_ok:
+            self._pos_ok = ok
+            self.lbl_position.setStyleSheet(self._POS_STYLES[ok])
+
     def start_auto_read(self):
         """[DRIVE] Kích hoạt timer đọc vị trí/trạng thái định kỳ."""
+        self._auto_reading = True
+        self._auto_interval = READ_INTERVAL_MS
         self.timer_auto_read.start(READ_INTERVAL_MS)
         self.status.setText("⟳ Auto-reading EZi-STEP status...")
         self.status.setStyleSheet("background-color: #87CEEB; padding: 8px; font-size: 11pt; font-weight: bold;")
 
     def stop_auto_read(self):
         """[DRIVE] Ngắt auto-read để người dùng điều khiển thủ công."""
+        self._auto_reading = False
         self.timer_auto_read.stop()
         self.status.setText("✓ Stopped auto-reading")
         self.status.setStyleSheet("background-color: #90EE90; padding: 8px; font-size: 11pt; font-weight: bold;")
 
     def auto_read_status(self):
-        """[DRIVE] Vòng đọc kép vị trí + trạng thái gọi bởi timer."""
-        self.read_position()
-        time.sleep(0.1)
-        self.read_status()
+        """[DRIVE] Vòng đọc vị trí + trạng thái gọi bởi timer (một FC03 gộp nếu BATCH_DRIVE_READS).
+
+        Không có gì thay đổi → nhân đôi chu kỳ (tối đa AUTO_READ_MAX_INTERVAL_MS);
+        position/status đổi → quay về READ_INTERVAL_MS.
+        """
+        before = (self.lbl_position.text(), self._shown_flags)
+        if BATCH_DRIVE_READS:
+            resp = self.send_and_read(self._frame_drive_bulk)
+            valid = len(resp) >= 39 and resp[1] == 0x03 and verify_crc(resp)
+            self._show_position(resp, valid)
+            self._show_status(resp, valid, 0x10)
+        else:
+            self.read_position()
+            self.read_status()
+        
+        if (self.lbl_position.text(), self._shown_flags) != before:
+            self._auto_interval = READ_INTERVAL_MS
+        else:
+            self._auto_interval = min(self._auto_interval * 2, AUTO_READ_MAX_INTERVAL_MS)
+        if self._auto_reading:
+            self.timer_auto_read.start(self._auto_interval)
+
+    def _kick_auto_read(self):
+        """[DRIVE] Sau mỗi lệnh gửi xuống driver: bỏ backoff lúc đứng yên, poll lại
+        theo READ_INTERVAL_MS để phản hồi (kể cả alarm) không bị trễ tới 2 s."""
+        if self._auto_reading:
+            self._auto_interval = READ_INTERVAL_MS
+            self.timer_auto_read.start(READ_INTERVAL_MS)
 
     # ===== Driver Commands =====
     def step_on(self):
         """[DRIVE] Bật nguồn step để driver sẵn sàng nhận lệnh."""
-        frame = build_fc06(SLAVE_ID, 0x0000, 1)
-        self.send_and_read(frame)
-        self.status.setText("✓ Step Motor ON")
+        if self._validate_echo(self.send_and_read(self._frame_step_on), 0x06):
+            self.status.setText("✓ Step Motor ON")
+        else:
+            self.status.setText("✗ Step Motor ON: no valid response")
+        self._kick_auto_read()
 
     def step_off(self):
         """[DRIVE] Tắt nguồn step nhằm hạ driver về trạng thái an toàn."""
-        frame = build_fc06(SLAVE_ID, 0x0000, 0)
-        self.send_and_read(frame)
-        self.status.setText("✓ Step Motor OFF")
+        if self._validate_echo(self.send_and_read(self._frame_step_off), 0x06):
+            self.status.setText("✓ Step Motor OFF")
+        else:
+            self.status.setText("✗ Step Motor OFF: no valid response")
+        self._kick_auto_read()
 
     def reset_alarm(self):
         """[DRIVE] Reset cờ alarm để xóa lỗi máy."""
-        frame = build_fc06(SLAVE_ID, 0x0001, 1)
-        self.send_and_read(frame)
-        self.status.setText("✓ Alarm Reset")
+        if self._validate_echo(self.send_and_read(self._frame_reset_alarm), 0x06):
+            self.status.setText("✓ Alarm Reset")
+        else:
+            self.status.setText("✗ Alarm Reset: no valid response")
+        self._kick_auto_read()
 
     def move_stop(self):
         """[DRIVE] Gửi lệnh dừng chuyển động khẩn cấp."""
-        frame = build_fc06(SLAVE_ID, 0x0002, 1)
-        self.send_and_read(frame)
-        self.status.setText("✓ Motor Stopped")
+        if self._validate_echo(self.send_and_read(self._frame_move_stop), 0x06):
+            self.status.setText("✓ Motor Stopped")
+        else:
+            self.status.setText("✗ Motor Stopped: no valid response")
+        self._kick_auto_read()
 
     def jog_cw(self):
         """[DRIVE] JOG theo chiều thuận với tốc độ đặt trong ô Speed."""
@@ -654,9 +807,12 @@ class DriverGUI(QWidget):
             pps = int(self.le_speed.text())
             dir_val = int(self.le_dir.text()) & 0xFF
             speed_regs = pack_u32_to_regs(pps)
-            frame = build_fc16(SLAVE_ID, 0x30, speed_regs + [0, dir_val])
-            self.send_and_read(frame)
-            self.status.setText(f"✓ JOG CW @ {pps} pps")
+            frame = finalize_fc16(self._prefix_velocity, speed_regs + [0, dir_val])
+            if self._validate_echo(self.send_and_read(frame), 0x10):
+                self.status.setText(f"✓ JOG CW @ {pps} pps")
+            else:
+                self.status.setText("✗ JOG CW: no valid response")
+            self._kick_auto_read()
         except ValueError:
             self.status.setText("✗ Error: Invalid speed/direction value")
 
@@ -666,9 +822,12 @@ class DriverGUI(QWidget):
             pps = int(self.le_speed.text())
             dir_val = 0 if int(self.le_dir.text()) == 1 else 1
             speed_regs = pack_u32_to_regs(pps)
-            frame = build_fc16(SLAVE_ID, 0x30, speed_regs + [0, dir_val])
-            self.send_and_read(frame)
-            self.status.setText(f"✓ JOG CCW @ {pps} pps")
+            frame = finalize_fc16(self._prefix_velocity, speed_regs + [0, dir_val])
+            if self._validate_echo(self.send_and_read(frame), 0x10):
+                self.status.setText(f"✓ JOG CCW @ {pps} pps")
+            else:
+                self.status.setText("✗ JOG CCW: no valid response")
+            self._kick_auto_read()
         except ValueError:
             self.status.setText("✗ Error: Invalid speed/direction value")
 
@@ -678,9 +837,12 @@ class DriverGUI(QWidget):
             pps = int(self.le_speed.text())
             direction = int(self.le_dir.text()) & 0xFF
             speed_regs = pack_u32_to_regs(pps)
-            frame = build_fc16(SLAVE_ID, 0x30, speed_regs + [0, direction])
-            self.send_and_read(frame)
-            self.status.setText(f"✓ Move Velocity: {pps} pps, Dir: {direction}")
+            frame = finalize_fc16(self._prefix_velocity, speed_regs + [0, direction])
+            if self._validate_echo(self.send_and_read(frame), 0x10):
+                self.status.setText(f"✓ Move Velocity: {pps} pps, Dir: {direction}")
+            else:
+                self.status.setText("✗ Move Velocity: no valid response")
+            self._kick_auto_read()
         except ValueError:
             self.status.setText("✗ Error: Invalid speed/direction value")
 
@@ -689,10 +851,13 @@ class DriverGUI(QWidget):
         try:
             pos = int(self.le_abspos.text())
             pps = int(self.le_runpps.text())
-            frame = build_fc16(SLAVE_ID, 0x10,
+            frame = finalize_fc16(self._prefix_abs,
                 pack_s32_to_regs(pos) + pack_u32_to_regs(pps))
-            self.send_and_read(frame)
-            self.status.setText(f"✓ Move Absolute: pos={pos}, speed={pps} pps")
+            if self._validate_echo(self.send_and_read(frame), 0x10):
+                self.status.setText(f"✓ Move Absolute: pos={pos}, speed={pps} pps")
+            else:
+                self.status.setText("✗ Move Absolute: no valid response")
+            self._kick_auto_read()
         except ValueError:
             self.status.setText("✗ Error: Invalid position/speed value")
 
@@ -701,10 +866,13 @@ class DriverGUI(QWidget):
         try:
             pos = int(self.le_abspos.text())
             pps = int(self.le_runpps.text())
-            frame = build_fc16(SLAVE_ID, 0x20,
+            frame = finalize_fc16(self._prefix_inc,
                 pack_s32_to_regs(pos) + pack_u32_to_regs(pps))
-            self.send_and_read(frame)
-            self.status.setText(f"✓ Move Incremental: pos={pos}, speed={pps} pps")
+            if self._validate_echo(self.send_and_read(frame), 0x10):
+                self.status.setText(f"✓ Move Incremental: pos={pos}, speed={pps} pps")
+            else:
+                self.status.setText("✗ Move Incremental: no valid response")
+            self._kick_auto_read()
         except ValueError:
             self.status.setText("✗ Error: Invalid position/speed value")
 
@@ -723,13 +891,11 @@ class DriverGUI(QWidget):
 
     def read_sht20(self):
         """[SHT20] Gửi FC04 và cập nhật nhãn nhiệt độ/độ ẩm."""
-        frame = build_read_sht20(SLAVE_ID_SHT20)
-        resp = self.send_and_read(frame)
+        resp = self.send_and_read(self._frame_sht20)
         
         if len(resp) >= 9 and resp[1] == 0x04:
             try:
-                temp = (resp[3] << 8) | resp[4]
-                humi = (resp[5] << 8) | resp[6]
+                temp, humi = unpack_regs(resp, 2)
                 self.lbl_temp.setText(f"Temp: {temp/10:.1f} °C")
                 self.lbl_humi.setText(f"Humi: {humi/10:.1f} %")
                 self.read_count += 1